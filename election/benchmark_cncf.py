@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""benchmark_cncf.py measures the time and memory used by cncf_emails.py
+to match eligible users against a synthetic devstats email map.
+
+Each mode runs in its own process, so that its peak RSS can be measured:
+
+* stream: the map is parsed incrementally, keeping only eligible users
+* full: the whole map is loaded, users are matched with match_users
+* twice: the whole map is loaded, users are matched with two full joins,
+  as cncf_emails.py used to do
+
+Usage:
+  python3 benchmark_cncf.py --users 500000 --eligible 700
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Tuple
+
+import pandas as pd
+
+import cncf_emails
+
+
+def make_map(filename: str, users: int) -> None:
+  """Write a JSON map with users records, some of them noreply."""
+  with open(filename, 'w') as f:
+    f.write("[\n")
+    for i in range(users):
+      domain = cncf_emails.NOREPLY_DOMAIN if i % 5 == 0 else "example.com"
+      record = dict(login="user{}".format(i), email="user{}!{}".format(i, domain),
+                    name="User {}".format(i), affiliation="Company {}".format(i % 100),
+                    source="config", commits=i % 1000, location="Somewhere",
+                    country_id="xx", sex="x", tz="UTC")
+      f.write(("," if i else "") + json.dumps(record) + "\n")
+    f.write("]\n")
+
+
+def make_users(filename: str, users: int, eligible: int) -> None:
+  """Write a devstats csv with eligible users, half of them in the map."""
+  step = users // eligible
+  rows = [dict(Rank=i + 1, name="user{}".format(i * step + 1 if i % 2
+                                                else users + i),
+               value=cncf_emails.MINIMUM_CONTRIBUTION_COUNT + i)
+          for i in range(eligible)]
+  pd.DataFrame(rows).to_csv(filename, index=False)
+
+
+def match_twice(eligible: pd.DataFrame, emailmap: pd.DataFrame
+                ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+  """The matching done by cncf_emails.py before match_users."""
+  found = pd.merge(eligible, emailmap, left_on='name', right_on='login', how='left', indicator=True).query('_merge == "both"').drop(columns='_merge')
+  found['email'] = found['email'].str.replace('!', '@')
+  missing = pd.merge(eligible, emailmap, left_on='name', right_on='login', how='left', indicator=True).query('_merge == "left_only"').drop(columns='_merge')
+  return found, missing
+
+
+def run(mode: str, map_file: str, users_file: str) -> None:
+  """Match the users in this process and print the results and its usage."""
+  users = pd.read_csv(users_file)
+  eligible = users[users['value'] >= cncf_emails.MINIMUM_CONTRIBUTION_COUNT]
+  if mode == "stream":
+    emailmap = cncf_emails.stream_email_map(map_file, set(eligible['name']))
+  else:
+    emailmap = cncf_emails.load_email_map(map_file)
+  start = time.time()
+  match = match_twice if mode == "twice" else cncf_emails.match_users
+  found, missing = match(eligible, emailmap)
+  elapsed = time.time() - start
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  print(len(found), len(missing), elapsed, peak)
+
+
+def measure(mode: str, map_file: str, users_file: str) -> None:
+  start = time.time()
+  out = subprocess.run([sys.executable, __file__, "--run", mode,
+                        "--map", map_file, "--users-file", users_file],
+                       check=True, capture_output=True, text=True).stdout
+  elapsed = time.time() - start
+  found, missing, match, peak = out.split()
+  print("{:<8} {:8.2f}s  match {:8.3f}s  peak RSS {:8.1f} MiB  "
+        "found {} missing {}".format(mode, elapsed, float(match), float(peak),
+                                     found, missing))
+
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser(
+      description="Benchmark matching users against the devstats email map")
+  arg_parser.add_argument("--users", type=int, default=500000,
+                          help="number of users in the synthetic map")
+  arg_parser.add_argument("--eligible", type=int, default=700,
+                          help="number of eligible users to match")
+  arg_parser.add_argument("--run", type=str, help=argparse.SUPPRESS)
+  arg_parser.add_argument("--map", type=str, help=argparse.SUPPRESS)
+  arg_parser.add_argument("--users-file", type=str, help=argparse.SUPPRESS)
+  args = arg_parser.parse_args()
+
+  if args.run:
+    run(args.run, args.map, args.users_file)
+    sys.exit(0)
+
+  with tempfile.TemporaryDirectory() as tmp:
+    map_file = os.path.join(tmp, "github_users.json")
+    users_file = os.path.join(tmp, "users.csv")
+    make_map(map_file, args.users)
+    make_users(users_file, args.users, args.eligible)
+    print("Map of {} users, {:.1f} MiB, {} eligible users".format(
+        args.users, os.path.getsize(map_file) / 1024 / 1024, args.eligible))
+    for mode in ("stream", "full", "twice"):
+      measure(mode, map_file, users_file)
@@ -13,17 +13,221 @@ which is one of the input files used by the CDF for devstats.
 The output will be a mapping of the GitHub username to the all email addresses
 contained in commits associated with this user in a csv file.
 
+The JSON map is downloaded to a local cache directory, and revalidated on
+following runs with its ETag and Last-Modified date, so that it is only
+downloaded again when it changed. Use --map-file to use a local copy instead.
+
+With --stream, the JSON map is parsed incrementally and only the records of
+eligible users are kept in memory. With --index, the map is converted once
+into a SQLite index of logins to emails, next to the map, and eligible users
+are looked up in it; the index is rebuilt when the map changes.
+
 Usage:
   python3 cncf_emails.py --file users.csv
+  python3 cncf_emails.py --file users.csv --stream
+  python3 cncf_emails.py --file users.csv --index
+  python3 cncf_emails.py --file users.csv --map-file github_users.json
 """
 import argparse
 import csv
+import json
+import os
+import sqlite3
 import requests
-from typing import List, Dict
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
 
 import pandas as pd
 
 EMAIL_MAP = "https://github.com/cncf/devstats/raw/master/github_users.json"
+NOREPLY_DOMAIN = "users.noreply.github.com"
+CHUNK_SIZE = 1024 * 1024
+MINIMUM_CONTRIBUTION_COUNT = 15
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "tekton-election")
+# SQLite limits the number of parameters of a query
+LOOKUP_BATCH_SIZE = 500
+
+
+def fetch_email_map(url: str, cache_dir: str) -> str:
+  """Download the email map to cache_dir, unless the cached copy is current.
+
+  Returns the path of the local copy. If the map cannot be downloaded,
+  the cached copy is used when there is one.
+  """
+  os.makedirs(cache_dir, exist_ok=True)
+  map_file = os.path.join(cache_dir, os.path.basename(url))
+  meta_file = map_file + ".meta"
+  meta = {}
+  if os.path.exists(map_file) and os.path.exists(meta_file):
+    with open(meta_file) as f:
+      meta = json.load(f)
+  headers = {}
+  if meta.get("etag"):
+    headers["If-None-Match"] = meta["etag"]
+  if meta.get("last_modified"):
+    headers["If-Modified-Since"] = meta["last_modified"]
+  try:
+    with requests.get(url, headers=headers, stream=True) as r:
+      if r.status_code == 304:
+        print("Using cached email map {}".format(map_file))
+        return map_file
+      r.raise_for_status()
+      print("Downloading email map to {}".format(map_file))
+      with open(map_file + ".tmp", "wb") as f:
+        for chunk in r.iter_content(CHUNK_SIZE):
+          f.write(chunk)
+      os.replace(map_file + ".tmp", map_file)
+      with open(meta_file, "w") as f:
+        json.dump(dict(etag=r.headers.get("ETag"),
+                       last_modified=r.headers.get("Last-Modified")), f)
+  except requests.exceptions.RequestException as e:
+    if not os.path.exists(map_file):
+      raise
+    print("Could not download the email map ({}), using {}".format(
+        e, map_file))
+  return map_file
+
+
+def map_stamp(map_file: str) -> str:
+  stat = os.stat(map_file)
+  return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+
+def build_index(map_file: str, index_file: str) -> None:
+  """Build a SQLite index of logins to emails from the email map."""
+  print("Indexing email map {} to {}".format(map_file, index_file))
+  with sqlite3.connect(index_file + ".tmp") as db:
+    db.execute("DROP TABLE IF EXISTS emails")
+    db.execute("DROP TABLE IF EXISTS meta")
+    db.execute("CREATE TABLE emails (login TEXT, email TEXT, name TEXT)")
+    db.execute("CREATE TABLE meta (stamp TEXT)")
+    db.executemany(
+        "INSERT INTO emails VALUES (?, ?, ?)",
+        ((r.get("login"), r.get("email"), r.get("name"))
+         for r in iter_json_array(read_chunks(map_file))
+         if not (r.get("email") or "").endswith(NOREPLY_DOMAIN)))
+    db.execute("CREATE INDEX emails_login ON emails (login)")
+    db.execute("INSERT INTO meta VALUES (?)", (map_stamp(map_file),))
+  db.close()
+  os.replace(index_file + ".tmp", index_file)
+
+
+def email_map_index(map_file: str) -> str:
+  """Return the index of the email map, building it if missing or stale."""
+  index_file = os.path.splitext(map_file)[0] + ".sqlite"
+  stamp = None
+  if os.path.exists(index_file):
+    try:
+      with sqlite3.connect(index_file) as db:
+        stamp = db.execute("SELECT stamp FROM meta").fetchone()[0]
+      db.close()
+    except sqlite3.Error:
+      pass
+  if stamp != map_stamp(map_file):
+    build_index(map_file, index_file)
+  return index_file
+
+
+def match_users(eligible: pd.DataFrame, emailmap: pd.DataFrame
+                ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+  """Split eligible users into those found in the email map and missing ones.
+
+  The map is first reduced to the eligible logins with a vectorized isin,
+  so that a single join only hashes the matching rows of the map.
+  """
+  emailmap = emailmap[emailmap['login'].isin(eligible['name'])]
+  merged = pd.merge(eligible, emailmap, left_on='name', right_on='login',
+                    how='left', indicator=True)
+  both = merged['_merge'] == 'both'
+  found = merged[both].drop(columns='_merge')
+  found['email'] = found['email'].str.replace('!', '@', regex=False)
+  missing = merged[~both].drop(columns='_merge')
+  return found, missing
+
+
+def lookup_email_map(index_file: str, logins: Set[str]) -> pd.DataFrame:
+  """Load the records of the email map index for the given logins only."""
+  logins = sorted(logins)
+  frames = []
+  with sqlite3.connect(index_file) as db:
+    for i in range(0, len(logins), LOOKUP_BATCH_SIZE):
+      batch = logins[i:i + LOOKUP_BATCH_SIZE]
+      frames.append(pd.read_sql_query(
+          "SELECT login, email, name FROM emails WHERE login IN ({})".format(
+              ",".join("?" * len(batch))), db, params=batch))
+  db.close()
+  if not frames:
+    return pd.DataFrame(columns=['login', 'email', 'name'])
+  return pd.concat(frames, ignore_index=True)
+
+
+def read_chunks(source: str, chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+  """Yield the text of a local file or URL in chunks."""
+  if source.startswith(("http://", "https://")):
+    with requests.get(source, stream=True) as r:
+      r.raise_for_status()
+      r.encoding = "utf-8"
+      yield from r.iter_content(chunk_size, decode_unicode=True)
+  else:
+    with open(source, encoding="utf-8") as f:
+      while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+          return
+        yield chunk
+
+
+def iter_json_array(chunks: Iterable[str]) -> Iterator[Dict]:
+  """Yield the items of a JSON array, parsing it incrementally from chunks."""
+  decoder = json.JSONDecoder()
+  buffer = ""
+  started = False
+  for chunk in chunks:
+    buffer += chunk
+    pos = 0
+    while True:
+      while pos < len(buffer) and buffer[pos].isspace():
+        pos += 1
+      if pos == len(buffer):
+        break
+      if not started:
+        if buffer[pos] != "[":
+          raise ValueError("expected a JSON array")
+        started = True
+        pos += 1
+      elif buffer[pos] == ",":
+        pos += 1
+      elif buffer[pos] == "]":
+        return
+      else:
+        try:
+          item, pos = decoder.raw_decode(buffer, pos)
+        except ValueError:
+          # the item continues in the next chunk
+          break
+        yield item
+    buffer = buffer[pos:]
+  raise ValueError("unexpected end of JSON array")
+
+
+def load_email_map(source: str) -> pd.DataFrame:
+  """Load the whole email map, without GitHub noreply emails."""
+  emailmap = pd.read_json(source)
+  return emailmap[~emailmap['email'].str.endswith(NOREPLY_DOMAIN)]
+
+
+def stream_email_map(source: str, logins: Set[str]) -> pd.DataFrame:
+  """Load the records of the email map for the given logins only.
+
+  The map is parsed incrementally, so that only matching records without
+  GitHub noreply emails are held in memory.
+  """
+  records = [r for r in iter_json_array(read_chunks(source))
+             if r.get('login') in logins
+             and not (r.get("email") or "").endswith(NOREPLY_DOMAIN)]
+  if not records:
+    return pd.DataFrame(columns=['login', 'email', 'name'])
+  return pd.DataFrame.from_records(records)
 
 if __name__ == '__main__':
   arg_parser = argparse.ArgumentParser(
@@ -32,20 +236,31 @@ if __name__ == '__main__':
                           help="A file containing the GitHub usernames to query, separated by a newline")
   arg_parser.add_argument("--csv", type=str, required=False,
                           help="csv file to write with results")
+  arg_parser.add_argument("--stream", action="store_true",
+                          help="parse the email map incrementally, keeping only eligible users")
+  arg_parser.add_argument("--index", action="store_true",
+                          help="look up eligible users in a SQLite index of the email map")
+  arg_parser.add_argument("--map-file", type=str, required=False,
+                          help="local copy of the email map to use instead of downloading it")
+  arg_parser.add_argument("--cache-dir", type=str, default=DEFAULT_CACHE_DIR,
+                          help="directory where the downloaded email map is cached")
   args = arg_parser.parse_args()
 
   csvfile = args.csv or "found_emails.csv"
   missingfile = "missing_emails.csv"
 
-  # load data
+  # load data and filter eligible users
   users = pd.read_csv(args.file)
-  emailmap = pd.read_json(EMAIL_MAP)
-  emailmap = emailmap[~emailmap['email'].str.endswith('users.noreply.github.com')]
-
-  # filter eligible users
-  eligible = users[users['value'] >= 15]
-  found = pd.merge(eligible, emailmap, left_on='name', right_on='login', how='left', indicator=True).query('_merge == "both"').drop(columns='_merge')
-  found['email'] = found['email'].str.replace('!', '@')
-  missing = pd.merge(eligible, emailmap, left_on='name', right_on='login', how='left', indicator=True).query('_merge == "left_only"').drop(columns='_merge')
+  eligible = users[users['value'] >= MINIMUM_CONTRIBUTION_COUNT]
+  map_file = args.map_file or fetch_email_map(EMAIL_MAP, args.cache_dir)
+  if args.index:
+    emailmap = lookup_email_map(email_map_index(map_file),
+                                set(eligible['name']))
+  elif args.stream:
+    emailmap = stream_email_map(map_file, set(eligible['name']))
+  else:
+    emailmap = load_email_map(map_file)
+
+  found, missing = match_users(eligible, emailmap)
   found.to_csv(csvfile, columns=['name_x', 'email'], header=False, index=False)
   missing.to_csv(missingfile, columns=['name_x'], header=False, index=False)
@@ -8,21 +8,50 @@ where each username is separated by a newline,
 and for each username, queries GitHub for their recent activity
 (https://developer.github.com/v3/activity/events/#list-events-performed-by-a-user).
 If they have a PushEvent that will contain the commit(s) and email addresses.
+Pages of events are fetched until enough emails that are not GitHub noreply
+addresses are found for the user.
 
 The output will be a mapping of the GitHub username to the all email addresses
 contained in commits associated with this user in a csv file.
 
+Users are queried concurrently over a shared HTTP session. When GitHub's
+rate limit is hit, all requests are paused until it resets. Users whose
+events could not be fetched are reported at the end of the run.
+Each user's row is appended to the csv file as soon as their events are
+processed, so that partial results survive a crash.
+
+The emails found for each user are also recorded, with the time they were
+fetched, in a checkpoint file. A run with --resume skips the users that are
+already in the checkpoint, unless their entry is older than --max-age hours,
+and only queries GitHub for the remaining ones.
+
 Usage:
   python3 github_emails.py --file users.csv --token $GITHUB_OAUTH_TOKEN
+  python3 github_emails.py --file users.csv --token $GITHUB_OAUTH_TOKEN --resume
 """
 import argparse
+import concurrent.futures
 import csv
+import itertools
+import json
+import os
+import threading
+import time
 import requests
-from typing import List, Dict
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 
 GITHUB_EVENTS_API = "https://api.github.com/users/{}/events"
 MINIMUM_CONTRIBUTION_COUNT = 15
+DEFAULT_CONCURRENCY = 8
+# The events API returns at most 300 events, in pages of up to 100
+EVENTS_PER_PAGE = 100
+DEFAULT_MAX_PAGES = 3
+DEFAULT_ENOUGH_EMAILS = 1
+NOREPLY_DOMAIN = "users.noreply.github.com"
+DEFAULT_CHECKPOINT = "emails_checkpoint.jsonl"
+DEFAULT_MAX_AGE_HOURS = 24
+MAX_ATTEMPTS = 5
 
 
 def eligible_users(filename: str, count: int) -> List[str]:
@@ -34,41 +63,204 @@ def eligible_users(filename: str, count: int) -> List[str]:
   return [u[0] for u in users]
 
 
-def query_github(users: List[str], token: str) -> Dict[str, Dict]:
-  results = {}
-  for user in users:
-    print("Getting events for {}".format(user))
+class RateLimiter:
+  """Pauses the requests of all workers until a rate limit window ends."""
 
-    url = GITHUB_EVENTS_API.format(user)
-    r = requests.get(url, headers={"Authorization": "token {}".format(token)})
-    try:
-      r.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-      print("Error for {}: {}".format(user, e))
-    results[user] = r.json()
-  return results
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._resume_at = 0.0
 
+  def pause(self, seconds: float) -> None:
+    with self._lock:
+      self._resume_at = max(self._resume_at, time.time() + seconds)
 
-def extract_emails(results: Dict[str, Dict]) -> Dict[str, List[str]]:
-  emails = {}
-  for user, result in results.items():
-    emails[user] = set()
-    for r in result:
-      if "type" in r and r["type"] == "PushEvent":
-        # Extract the email from the first commit
-        if "payload" in r and "commits" in r["payload"]:
-          commits = r["payload"]["commits"]
-          if (len(commits) > 0 and "author" in commits[0]
-              and "email" in commits[0]["author"]):
-            emails[user].add(commits[0]["author"]["email"])
+  def wait(self) -> None:
+    with self._lock:
+      delay = self._resume_at - time.time()
+    if delay > 0:
+      time.sleep(delay)
+
+
+def make_session(token: str, concurrency: int) -> requests.Session:
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(
+      pool_connections=concurrency, pool_maxsize=concurrency)
+  session.mount("https://", adapter)
+  session.mount("http://", adapter)
+  session.headers["Authorization"] = "token {}".format(token)
+  return session
+
+
+def rate_limit_reset(response: requests.Response) -> Optional[float]:
+  """Seconds until the rate limit resets, if the response exhausted it."""
+  if response.headers.get("X-RateLimit-Remaining") != "0":
+    return None
+  reset = int(response.headers.get("X-RateLimit-Reset", 0))
+  return max(1.0, reset - time.time())
+
+
+def retry_delay(response: requests.Response, attempt: int) -> Optional[float]:
+  """Seconds to wait before retrying the request, None if it should not be."""
+  if response.status_code in (403, 429):
+    if "Retry-After" in response.headers:
+      return float(response.headers["Retry-After"])
+    reset = rate_limit_reset(response)
+    if reset is not None:
+      return reset
+    if response.status_code == 429:
+      return 2 ** attempt
+  if response.status_code >= 500:
+    return 2 ** attempt
+  return None
+
+
+def fetch_events(session: requests.Session, url: str, limiter: RateLimiter
+                 ) -> Tuple[List[Dict], Optional[str], int]:
+  """Fetch a page of events, returning the events, the URL of the next page
+  and the number of requests made."""
+  for attempt in range(MAX_ATTEMPTS):
+    limiter.wait()
+    r = session.get(url)
+    delay = retry_delay(r, attempt)
+    if delay is None or attempt == MAX_ATTEMPTS - 1:
+      break
+    print("Retrying {} in {:.0f}s (HTTP {})".format(url, delay, r.status_code))
+    limiter.pause(delay)
+  r.raise_for_status()
+  reset = rate_limit_reset(r)
+  if reset is not None:
+    limiter.pause(reset)
+  return r.json(), r.links.get("next", {}).get("url"), attempt + 1
+
+
+def user_emails(session: requests.Session, url: str, limiter: RateLimiter,
+                max_pages: int, enough: int) -> Tuple[Set[str], int]:
+  """Fetch the events of a user, keeping only the emails found in them.
+
+  Pages of events are fetched until max_pages is reached or enough
+  distinct non noreply emails are found. Returns the emails and the
+  number of requests made.
+  """
+  emails = set()
+  requests_made = 0
+  pages = 0
+  while url and pages < max_pages:
+    events, url, attempts = fetch_events(session, url, limiter)
+    pages += 1
+    requests_made += attempts
+    emails |= extract_user_emails(events)
+    if len([e for e in emails if not e.endswith(NOREPLY_DOMAIN)]) >= enough:
+      break
+  return emails, requests_made
+
+
+def query_github(users: List[str], token: str,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 api: str = GITHUB_EVENTS_API,
+                 failures: Optional[Dict[str, str]] = None,
+                 max_pages: int = DEFAULT_MAX_PAGES,
+                 enough: int = DEFAULT_ENOUGH_EMAILS,
+                 requests_made: Optional[Dict[str, int]] = None
+                 ) -> Iterator[Tuple[str, Set[str]]]:
+  """Yield the emails of each user as soon as their events are processed.
+
+  Event payloads are dropped by the workers once the emails are extracted.
+  Users whose events could not be fetched are added to failures, and the
+  number of requests made for each user to requests_made.
+  """
+  limiter = RateLimiter()
+  with make_session(token, concurrency) as session:
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+      futures = {executor.submit(
+          user_emails, session,
+          "{}?per_page={}".format(api.format(user), EVENTS_PER_PAGE),
+          limiter, max_pages, enough): user for user in users}
+      for future in concurrent.futures.as_completed(futures):
+        user = futures.pop(future)
+        try:
+          emails, user_requests = future.result()
+        except (requests.exceptions.RequestException, ValueError) as e:
+          print("Error for {}: {}".format(user, e))
+          if failures is not None:
+            failures[user] = str(e)
+          continue
+        print("Got {} emails for {}".format(len(emails), user))
+        if requests_made is not None:
+          requests_made[user] = user_requests
+        yield user, emails
+
+
+def extract_user_emails(events: List[Dict]) -> Set[str]:
+  emails = set()
+  for r in events:
+    if "type" in r and r["type"] == "PushEvent":
+      # Extract the emails from all the commits in the push
+      for commit in r.get("payload", {}).get("commits", []):
+        if "email" in commit.get("author", {}):
+          emails.add(commit["author"]["email"])
   return emails
 
 
-def make_csv(csvfile: str, emails: Dict[str, List[str]]) -> None:
+def extract_emails(results: Dict[str, Dict]) -> Dict[str, List[str]]:
+  return {user: extract_user_emails(result)
+          for user, result in results.items()}
+
+
+class Checkpoint:
+  """Records the emails found for each user in a JSONL file.
+
+  Each line holds a user, the time their events were fetched and the
+  emails found. Lines are flushed as they are written, later lines for
+  the same user replace earlier ones.
+  """
+
+  def __init__(self, filename: str, resume: bool = False):
+    self.entries = {}
+    lines = []
+    if resume and os.path.exists(filename):
+      with open(filename) as f:
+        lines = f.readlines()
+    for line in lines:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        # the last line may be truncated if the previous run crashed
+        continue
+      self.entries[entry["user"]] = entry
+    self._file = open(filename, 'a' if resume else 'w')
+    if lines and not lines[-1].endswith("\n"):
+      self._file.write("\n")
+
+  def __enter__(self) -> 'Checkpoint':
+    return self
+
+  def __exit__(self, *args) -> None:
+    self._file.close()
+
+  def completed(self, max_age: float) -> Dict[str, Set[str]]:
+    """Emails of the users fetched less than max_age seconds ago."""
+    oldest = time.time() - max_age
+    return {user: set(entry["emails"]) for user, entry in self.entries.items()
+            if entry["fetched_at"] >= oldest}
+
+  def record(self, results: Iterable[Tuple[str, Set[str]]]
+             ) -> Iterator[Tuple[str, Set[str]]]:
+    """Record each result as it goes by."""
+    for user, emails in results:
+      entry = dict(user=user, fetched_at=time.time(), emails=sorted(emails))
+      self._file.write(json.dumps(entry) + "\n")
+      self._file.flush()
+      self.entries[user] = entry
+      yield user, emails
+
+
+def make_csv(csvfile: str, emails: Iterable[Tuple[str, Set[str]]]) -> None:
+  """Write a row for each user, flushing it so partial results survive."""
   with open(csvfile, 'w') as f:
     w = csv.writer(f, delimiter=',')
-    for user, emails in emails.items():
-      w.writerow([user] + list(emails))
+    for user, user_emails in emails:
+      w.writerow([user] + sorted(user_emails))
+      f.flush()
 
 
 if __name__ == '__main__':
@@ -82,14 +274,47 @@ if __name__ == '__main__':
                           help="csv file to write with results")
   arg_parser.add_argument("--count", type=int, required=False,
                           help="minimum contribution count to be eligble")
+  arg_parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                          help="maximum number of concurrent requests to GitHub")
+  arg_parser.add_argument("--max-pages", type=int, default=DEFAULT_MAX_PAGES,
+                          help="maximum number of pages of events to fetch per user")
+  arg_parser.add_argument("--enough-emails", type=int, default=DEFAULT_ENOUGH_EMAILS,
+                          help="stop fetching events for a user after finding this many emails")
+  arg_parser.add_argument("--checkpoint", type=str, default=DEFAULT_CHECKPOINT,
+                          help="file recording the emails found for each user")
+  arg_parser.add_argument("--resume", action="store_true",
+                          help="skip users already recorded in the checkpoint file")
+  arg_parser.add_argument("--max-age", type=float, default=DEFAULT_MAX_AGE_HOURS,
+                          help="hours after which checkpointed users are queried again")
+  arg_parser.add_argument("--events-api", type=str, default=GITHUB_EVENTS_API,
+                          help="URL template of the GitHub user events API")
   args = arg_parser.parse_args()
 
   csvfile = args.csv or "emails.csv"
   count = args.count or MINIMUM_CONTRIBUTION_COUNT
 
   users = eligible_users(args.file, count)
-  results = query_github(users, args.token)
-  emails = extract_emails(results)
-  print(emails)
-  make_csv(csvfile, emails)
+  failures = {}
+  requests_made = {}
+  with Checkpoint(args.checkpoint, args.resume) as checkpoint:
+    done = checkpoint.completed(args.max_age * 3600)
+    pending = [u for u in users if u not in done]
+    if args.resume:
+      print("Skipping {} users found in {}".format(
+          len(users) - len(pending), args.checkpoint))
+    results = query_github(pending, args.token, args.concurrency,
+                           args.events_api, failures, args.max_pages,
+                           args.enough_emails, requests_made)
+    make_csv(csvfile, itertools.chain(
+        ((u, done[u]) for u in users if u in done),
+        checkpoint.record(results)))
+  if requests_made:
+    total = sum(requests_made.values())
+    found = sum(len(checkpoint.entries[u]["emails"]) for u in requests_made)
+    print("Made {} requests for {} users ({:.2f} per user, {:.2f} per email "
+          "found)".format(total, len(requests_made),
+                          total / len(requests_made), total / max(found, 1)))
+  if failures:
+    print("Could not get events for {} users: {}".format(
+        len(failures), ", ".join(sorted(failures))))
 
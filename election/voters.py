@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""voters.py finds the email addresses of eligible voters from all sources.
+
+The script loads the devstats CSV of users once (see cncf_emails.py for how
+to download it), and looks eligible users up in the CNCF email map first,
+which is cheap once the map is cached locally. Only the users that are not
+in the map are then queried on GitHub, as done by github_emails.py.
+
+The output is a single csv file with the username, the source the emails
+were found in and the emails, and a csv file with the usernames for which
+no email was found. Hit rates and timings for each source are reported at
+the end of the run.
+
+Usage:
+  python3 voters.py --file users.csv --token $GITHUB_OAUTH_TOKEN
+  python3 voters.py --file users.csv --token $GITHUB_OAUTH_TOKEN --index --resume
+"""
+import argparse
+import csv
+import itertools
+import time
+from typing import Dict, List, Optional, Set
+
+import pandas as pd
+
+import cncf_emails
+import github_emails
+
+# Apart from the github_emails.py checkpoint, as runs without --resume
+# truncate their checkpoint
+DEFAULT_CHECKPOINT = "voters_checkpoint.jsonl"
+
+
+def cncf_lookup(eligible: pd.DataFrame, args: argparse.Namespace
+                ) -> Dict[str, Set[str]]:
+  """Emails of the eligible users found in the CNCF email map."""
+  map_file = args.map_file or cncf_emails.fetch_email_map(
+      cncf_emails.EMAIL_MAP, args.cache_dir)
+  logins = set(eligible['name'])
+  if args.index:
+    emailmap = cncf_emails.lookup_email_map(
+        cncf_emails.email_map_index(map_file), logins)
+  else:
+    emailmap = cncf_emails.stream_email_map(map_file, logins)
+  found, _ = cncf_emails.match_users(eligible, emailmap)
+  return {user: set(emails) for user, emails
+          in found.groupby('name_x')['email']}
+
+
+def github_lookup(users: List[str], args: argparse.Namespace,
+                  requests_made: Dict[str, int]) -> Dict[str, Set[str]]:
+  """Emails of the users found in their GitHub events."""
+  failures = {}
+  with github_emails.Checkpoint(args.checkpoint, args.resume) as checkpoint:
+    done = checkpoint.completed(args.max_age * 3600)
+    pending = [u for u in users if u not in done]
+    results = github_emails.query_github(
+        pending, args.token, args.concurrency, args.events_api, failures,
+        args.max_pages, args.enough_emails, requests_made)
+    found = dict(itertools.chain(
+        ((u, done[u]) for u in users if u in done),
+        checkpoint.record(results)))
+  if failures:
+    print("Could not get events for {} users: {}".format(
+        len(failures), ", ".join(sorted(failures))))
+  return {user: emails for user, emails in found.items() if emails}
+
+
+def report(source: str, found: int, total: int,
+           elapsed: Optional[float] = None) -> None:
+  print("{:<8} found {:4d}/{:4d} users ({:5.1f}%){}".format(
+      source, found, total, 100 * found / max(total, 1),
+      "" if elapsed is None else " in {:.2f}s".format(elapsed)))
+
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser(
+      description="Find email addresses of eligible voters from all sources")
+  arg_parser.add_argument("--file", type=str, required=True,
+                          help="the devstats csv file with the users and their contributions")
+  arg_parser.add_argument("--token", type=str, required=False,
+                          help="GitHub oauth token, users missing from the CNCF map are not queried on GitHub without it")
+  arg_parser.add_argument("--count", type=int, default=github_emails.MINIMUM_CONTRIBUTION_COUNT,
+                          help="minimum contribution count to be eligble")
+  arg_parser.add_argument("--csv", type=str, default="voters.csv",
+                          help="csv file to write with the users found")
+  arg_parser.add_argument("--missing-csv", type=str, default="missing_voters.csv",
+                          help="csv file to write with the users not found")
+  arg_parser.add_argument("--index", action="store_true",
+                          help="look up eligible users in a SQLite index of the email map")
+  arg_parser.add_argument("--map-file", type=str, required=False,
+                          help="local copy of the email map to use instead of downloading it")
+  arg_parser.add_argument("--cache-dir", type=str, default=cncf_emails.DEFAULT_CACHE_DIR,
+                          help="directory where the downloaded email map is cached")
+  arg_parser.add_argument("--concurrency", type=int, default=github_emails.DEFAULT_CONCURRENCY,
+                          help="maximum number of concurrent requests to GitHub")
+  arg_parser.add_argument("--max-pages", type=int, default=github_emails.DEFAULT_MAX_PAGES,
+                          help="maximum number of pages of events to fetch per user")
+  arg_parser.add_argument("--enough-emails", type=int, default=github_emails.DEFAULT_ENOUGH_EMAILS,
+                          help="stop fetching events for a user after finding this many emails")
+  arg_parser.add_argument("--checkpoint", type=str, default=DEFAULT_CHECKPOINT,
+                          help="file recording the emails found on GitHub for each user")
+  arg_parser.add_argument("--resume", action="store_true",
+                          help="skip users already recorded in the checkpoint file")
+  arg_parser.add_argument("--max-age", type=float, default=github_emails.DEFAULT_MAX_AGE_HOURS,
+                          help="hours after which checkpointed users are queried again")
+  arg_parser.add_argument("--events-api", type=str, default=github_emails.GITHUB_EVENTS_API,
+                          help="URL template of the GitHub user events API")
+  args = arg_parser.parse_args()
+
+  users = pd.read_csv(args.file)
+  eligible = users[users['value'] >= args.count]
+  names = list(eligible['name'])
+  print("{} eligible users".format(len(names)))
+
+  start = time.time()
+  cncf = cncf_lookup(eligible, args)
+  report("cncf", len(cncf), len(names), time.time() - start)
+
+  github = {}
+  missing = [u for u in names if u not in cncf]
+  if args.token and missing:
+    start = time.time()
+    requests_made = {}
+    github = github_lookup(missing, args, requests_made)
+    report("github", len(github), len(missing), time.time() - start)
+    print("{:<8} made {} requests".format("github",
+                                         sum(requests_made.values())))
+  elif missing:
+    print("No --token, not querying GitHub for {} users".format(len(missing)))
+
+  with open(args.csv, 'w') as f:
+    w = csv.writer(f, delimiter=',')
+    for user in names:
+      for source, emails in (("cncf", cncf), ("github", github)):
+        if user in emails:
+          w.writerow([user, source] + sorted(emails[user]))
+          break
+  missing = [u for u in names if u not in cncf and u not in github]
+  with open(args.missing_csv, 'w') as f:
+    w = csv.writer(f, delimiter=',')
+    for user in missing:
+      w.writerow([user])
+  report("total", len(names) - len(missing), len(names))
@@ -28,59 +28,392 @@
 # This script is meant as a one-off to setup the initial teams. Further
 # edits to the teams will be managed by PRs to the org/org.yaml config.
 
+# Repos are searched in parallel, as the pages of repos are fetched. The
+# org members, and the contributors and maintainers found for each repo,
+# are cached on disk with the date they were collected, so that re-runs
+# only fetch the members or search the repos older than --max-age.
+
+# With --backend graphql, the org members, repos and maintainer teams are
+# fetched with a few batched GraphQL queries instead of one REST call per
+# page, repo and team. Contributor stats are only available via REST, so
+# they are still fetched for each repo that needs to be searched.
+
+import argparse
+from concurrent import futures
+import contextlib
+from datetime import date
+import difflib
+import io
+import json
 import logging
 import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
 
 import github
 from ruamel.yaml import YAML
 
 
 ORG_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'org.yaml')
+ORG_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '.collaborators-cache.json')
 GOVERNANCE_TEAM = ['afrittoli', 'chitrangpatel', 'jerop', 'vdemeester', 'wlynch']
+GITHUB_API = 'https://api.github.com'
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_AGE_DAYS = 1
+BACKENDS = ['rest', 'graphql']
+GRAPHQL_PAGE_SIZE = 100
+# Sequences in org.yaml are mostly not indented within their mapping
+SEQUENCE_INDENT = dict(mapping=2, sequence=2, offset=0)
+# GitHub answers 202 while it computes the stats, poll with backoff
+STATS_ATTEMPTS = 6
+STATS_BACKOFF = 2
+
+def get_stats_contributors(repo):
+    """ Get the contributors stats of a repo, waiting while they are computed
+
+    PyGithub returns None both while GitHub computes the stats and for
+    repos without stats, so the status of the response is checked here.
+
+    :returns: the list of stats as returned by GitHub, or None when they
+      are not computed yet
+    """
+    url = f'{repo.url}/stats/contributors'
+    for attempt in range(STATS_ATTEMPTS):
+        status, _, output = repo._requester.requestJson('GET', url)
+        if status >= 400:
+            raise github.GithubException(status, output)
+        if status != 202:
+            return json.loads(output) if output else []
+        delay = STATS_BACKOFF ** attempt
+        logging.info(f'Stats for {repo.name} not ready, retrying in {delay}s')
+        time.sleep(delay)
+    logging.warning(f'Stats for {repo.name} not available, skipping it')
+    return None
+
+
+class PhaseTimer:
+    """ Accumulates the time spent in each phase of a sweep
+
+    Phases may run in several threads at once, in which case the time
+    of all threads is added up.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.totals[name] = (self.totals.get(name, 0) +
+                                     time.monotonic() - start)
+
+    def report(self):
+        for name, total in self.totals.items():
+            print(f'{name:<10} {total:8.2f}s')
+
+
+def search_repo(repo, timer):
+    """ Search the contributors with 5+ commits and maintainers of a repo """
+    logging.info(f'Searching contributors to {repo.name}')
+    with timer.phase('stats'):
+        stats = get_stats_contributors(repo)
+        contributors = [dict(login=x['author']['login'],
+                             node_id=x['author']['node_id'])
+                        for x in stats or [] if x['total'] >= 5]
+
+    logging.info(f'Searching maintainers to {repo.name}')
+    maintainers = []
+    with timer.phase('teams'):
+        for team in repo.get_teams():
+            if team.name.endswith('.maintainers'):
+                maintainers = [x.login for x in team.get_members()]
+                break
+    # Without stats the repo is not dated, so that it's searched again
+    searched = date.today().isoformat() if stats is not None else None
+    return dict(date=searched, contributors=contributors,
+                maintainers=maintainers)
+
+
+def search_result(repo_name, search, cached):
+    """ The result of the search of a repo, or its cached entry undated
+
+    A repo that can't be searched doesn't fail the sweep, its previous
+    entry is kept without a date so that it's searched again.
+    """
+    try:
+        return search.result()
+    except (github.GithubException, OSError) as e:
+        logging.warning(f'Searching {repo_name} failed, skipping it: {e}')
+        return dict(cached or dict(contributors=[], maintainers=[]),
+                    date=None)
+
+
+def is_stale(cached, max_age):
+    """ Whether a cached entry was collected more than max_age days ago """
+    if cached is None or cached['date'] is None:
+        return True
+    return (date.today() - date.fromisoformat(cached['date'])).days >= max_age
+
+
+def load_cache(cache_file):
+    """ Load the cached org members and repos """
+    cache = dict(members=None, repos={})
+    if not cache_file or not os.path.exists(cache_file):
+        return cache
+    try:
+        with open(cache_file, 'r') as cache_io:
+            cache.update(json.load(cache_io))
+    except (IOError, ValueError) as e:
+        logging.warning(f'Ignoring invalid cache {cache_file}: {e}')
+    return cache
 
-def get_contributors_maintainers(github_token):
-    g = github.Github(github_token)
 
-    # Get the ORG members
+def save_cache(cache_file, cache):
+    if not cache_file:
+        return
+    with open(cache_file, 'w') as cache_io:
+        json.dump(cache, cache_io, indent=2, sort_keys=True)
+
+
+def get_contributors_maintainers(github_token, workers=DEFAULT_WORKERS,
+                                 cache_file=ORG_CACHE,
+                                 max_age=DEFAULT_MAX_AGE_DAYS,
+                                 base_url=GITHUB_API):
+    g = github.Github(github_token, base_url=base_url)
     tektoncd = g.get_organization("tektoncd")
-    members = [x for x in tektoncd.get_members()]
-    members_ids = [x.node_id for x in members]
+    cache = load_cache(cache_file)
+    timer = PhaseTimer()
+
+    # Get the ORG members, as a set of node ids persisted in the cache
+    with timer.phase('members'):
+        if is_stale(cache['members'], max_age):
+            cache['members'] = dict(
+                date=date.today().isoformat(),
+                node_ids=sorted(x.node_id for x in tektoncd.get_members()))
+        members_ids = set(cache['members']['node_ids'])
 
-    # Get the list of repos
-    repos = [x for x in tektoncd.get_repos() if x.name != '.github']
+    # Search the repos that are not cached or whose cache is stale, as
+    # the pages of repos are fetched
+    repos_cache = cache['repos']
+    repo_names = []
+    searches = {}
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        repos = iter(tektoncd.get_repos())
+        while True:
+            with timer.phase('repos'):
+                repo = next(repos, None)
+            if repo is None:
+                break
+            if repo.name == '.github':
+                continue
+            repo_names.append(repo.name)
+            if is_stale(repos_cache.get(repo.name), max_age):
+                searches[repo.name] = executor.submit(
+                    search_repo, repo, timer)
+        logging.info(f'Searching {len(searches)} of {len(repo_names)} repos')
+        for name, search in searches.items():
+            repos_cache[name] = search_result(
+                name, search, repos_cache.get(name))
+    cache['repos'] = {name: repos_cache[name] for name in repo_names}
+    save_cache(cache_file, cache)
+    timer.report()
+    return collect_contributors(cache, members_ids)
 
+
+def collect_contributors(cache, members_ids):
+    """ The contributors of each repo that are org members """
     # Get stats/contributors for each repo with 5+ commits
     contributors = {}
     maintainers = set()
-    for repo in repos:
-        logging.info(f'Searching contributors to {repo.name}')
+    for repo, result in cache['repos'].items():
         # Get the list of contributors that have 5+ commits and are members
-        contributors[repo.name] = set([
-            x.author.login for x in repo.get_stats_contributors()
-            if x.total >= 5 and x.author.node_id in members_ids])
-
-        # Get the list of maintainers and merge them to a set
-        logging.info(f'Searching maintainers to {repo.name}')
-        _maintainers = [x for x in repo.get_teams()
-            if x.name.endswith('.maintainers')]
-        if len(_maintainers) > 0:
-            maintainers.update([x.login for x in _maintainers[0].get_members()])
+        contributors[repo] = set([
+            x['login'] for x in result['contributors']
+            if x['node_id'] in members_ids])
+        # Merge the list of maintainers to a set
+        maintainers.update(result['maintainers'])
 
     # Any maintainer on any repo is allowed to lgtm on community (for TEPs)
     contributors['community'] = maintainers
-
     return contributors
 
 
-def update_collaborator_teams(contributors):
-    yaml = YAML()
+class GraphQLClient:
+    """ A minimal client for the GitHub GraphQL API and REST stats """
 
-    # Load the YAML config
-    logging.info(f'Loading org configuration from {ORG_CONFIG}')
-    with open(ORG_CONFIG, 'r') as org_config_file:
-        org_config = yaml.load(org_config_file)
+    def __init__(self, github_token, base_url=GITHUB_API):
+        self.base_url = base_url.rstrip('/')
+        self.headers = {'Authorization': f'bearer {github_token}',
+                        'Accept': 'application/vnd.github+json'}
+
+    def request(self, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(f'{self.base_url}{path}', data=data,
+                                         headers=self.headers)
+        with urllib.request.urlopen(request) as response:
+            payload = response.read()
+            return response.status, json.loads(payload) if payload else None
+
+    def query(self, query, variables):
+        _, result = self.request('/graphql', dict(query=query,
+                                                  variables=variables))
+        if result.get('errors'):
+            raise RuntimeError(f'GraphQL query failed: {result["errors"]}')
+        return result['data']
+
+    def stats_contributors(self, repo_name):
+        """ Like get_stats_contributors, for a repo of the org by name """
+        for attempt in range(STATS_ATTEMPTS):
+            status, stats = self.request(
+                f'/repos/tektoncd/{repo_name}/stats/contributors')
+            if status != 202:
+                return stats or []
+            delay = STATS_BACKOFF ** attempt
+            logging.info(f'Stats for {repo_name} not ready, retrying in {delay}s')
+            time.sleep(delay)
+        logging.warning(f'Stats for {repo_name} not available, skipping it')
+        return None
+
+
+# The first page of members and repositories of each team is fetched
+# with the teams, graphql_team_pages fetches the following ones
+TEAM_CONNECTIONS = dict(
+    members='members(first: {size}{after}) {{ '
+            'pageInfo {{ hasNextPage endCursor }} nodes {{ login }} }}',
+    repositories='repositories(first: {size}{after}) {{ '
+                 'pageInfo {{ hasNextPage endCursor }} nodes {{ name }} }}')
+# Each connection of the org is paginated on its own, the query for a page
+# only includes the connections that have more pages to fetch
+ORG_CONNECTIONS = dict(
+    members='membersWithRole(first: {size}, after: $members) {{ '
+            'pageInfo {{ hasNextPage endCursor }} nodes {{ id }} }}',
+    repos='repositories(first: {size}, after: $repos, orderBy: {{field: NAME, direction: ASC}}) {{ '
+          'pageInfo {{ hasNextPage endCursor }} nodes {{ name }} }}',
+    teams='teams(first: {size}, after: $teams, query: ".maintainers") {{ '
+          'pageInfo {{ hasNextPage endCursor }} nodes {{ name slug ' +
+          ' '.join(TEAM_CONNECTIONS.values()) + ' }} }}')
+
+
+def graphql_org(client, connections, page_size=GRAPHQL_PAGE_SIZE):
+    """ Fetch all the nodes of the given connections of the tektoncd org
+
+    :returns: a dict of connection name to the list of its nodes
+    """
+    nodes = {name: [] for name in connections}
+    cursors = {name: None for name in connections}
+    while cursors:
+        fields = ' '.join(f'{name}: ' + ORG_CONNECTIONS[name].format(
+                              size=page_size, after='')
+                          for name in cursors)
+        params = ', '.join(f'${name}: String' for name in cursors)
+        query = (f'query({params}) {{ organization(login: "tektoncd") '
+                 f'{{ {fields} }} }}')
+        org = client.query(query, cursors)['organization']
+        for name in list(cursors):
+            nodes[name].extend(org[name]['nodes'])
+            if org[name]['pageInfo']['hasNextPage']:
+                cursors[name] = org[name]['pageInfo']['endCursor']
+            else:
+                del cursors[name]
+    for team in nodes.get('teams', []):
+        graphql_team_pages(client, team, page_size)
+    return nodes
+
+
+def graphql_team_pages(client, team, page_size=GRAPHQL_PAGE_SIZE):
+    """ Fetch the members and repositories of a team beyond the first page
+
+    The nodes are added to the team, as returned by graphql_org.
+    """
+    for name, connection in TEAM_CONNECTIONS.items():
+        page = team[name]
+        while page['pageInfo']['hasNextPage']:
+            fields = connection.format(size=page_size, after=', after: $after')
+            query = ('query($slug: String!, $after: String) { organization('
+                     f'login: "tektoncd") {{ team(slug: $slug) {{ {fields} '
+                     '} } }')
+            page = client.query(query, dict(
+                slug=team['slug'], after=page['pageInfo']['endCursor'])
+            )['organization']['team'][name]
+            team[name]['nodes'].extend(page['nodes'])
 
-    # Update the config with collaborator teams
+
+def graphql_search_repo(client, repo_name, maintainers, timer):
+    """ Like search_repo, with maintainers already found via GraphQL """
+    logging.info(f'Searching contributors to {repo_name}')
+    with timer.phase('stats'):
+        stats = client.stats_contributors(repo_name)
+        contributors = [dict(login=x['author']['login'],
+                             node_id=x['author']['node_id'])
+                        for x in stats or [] if x['total'] >= 5]
+    searched = date.today().isoformat() if stats is not None else None
+    return dict(date=searched, contributors=contributors,
+                maintainers=maintainers)
+
+
+def get_contributors_maintainers_graphql(github_token, workers=DEFAULT_WORKERS,
+                                         cache_file=ORG_CACHE,
+                                         max_age=DEFAULT_MAX_AGE_DAYS,
+                                         base_url=GITHUB_API,
+                                         page_size=GRAPHQL_PAGE_SIZE):
+    """ Like get_contributors_maintainers, using batched GraphQL queries """
+    client = GraphQLClient(github_token, base_url=base_url)
+    cache = load_cache(cache_file)
+    timer = PhaseTimer()
+
+    # Fetch the members, when the cache is stale, repos and maintainer
+    # teams of the org together
+    connections = ['repos', 'teams']
+    if is_stale(cache['members'], max_age):
+        connections.append('members')
+    with timer.phase('graphql'):
+        org = graphql_org(client, connections, page_size)
+    if 'members' in org:
+        cache['members'] = dict(
+            date=date.today().isoformat(),
+            node_ids=sorted(x['id'] for x in org['members']))
+    members_ids = set(cache['members']['node_ids'])
+
+    # Use the first maintainers team of each repo, as search_repo does
+    maintainers = {}
+    for team in org['teams']:
+        if not team['name'].endswith('.maintainers'):
+            continue
+        for repo in team['repositories']['nodes']:
+            maintainers.setdefault(
+                repo['name'], [x['login'] for x in team['members']['nodes']])
+
+    repos_cache = cache['repos']
+    repo_names = [x['name'] for x in org['repos'] if x['name'] != '.github']
+    stale = [name for name in repo_names
+             if is_stale(repos_cache.get(name), max_age)]
+    logging.info(f'Searching {len(stale)} of {len(repo_names)} repos')
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        searches = {name: executor.submit(
+                        graphql_search_repo, client, name,
+                        maintainers.get(name, []), timer)
+                    for name in stale}
+        for name, search in searches.items():
+            repos_cache[name] = search_result(
+                name, search, repos_cache.get(name))
+    cache['repos'] = {name: repos_cache[name] for name in repo_names}
+    save_cache(cache_file, cache)
+    timer.report()
+    return collect_contributors(cache, members_ids)
+
+
+def desired_teams(contributors):
+    """ Build the collaborator teams for the contributors of each repo """
+    teams = {}
     for repo, collaborators in contributors.items():
         repo_name = repo if repo != 'pipeline' else 'core'
         team_name = f'{repo_name}.collaborators'
@@ -88,25 +421,205 @@ def update_collaborator_teams(contributors):
         # maintaining the configuration via periobolos and not via GitHub
         # Setting the governance team as default as a backup.
         maintainers = [m for m in GOVERNANCE_TEAM if m not in collaborators] or ['bobcatfish']
-        team = dict(
+        teams[team_name] = dict(
             description=f'The {repo_name} collaborators',
             maintainers=maintainers,
-            members = [c for c in collaborators if c not in maintainers],
+            members = sorted([c for c in collaborators if c not in maintainers],
+                             key=str.lower),
             privacy = 'closed',
             repos = {repo: 'read'}
         )
-        logging.info(f'Adding team {team_name}')
-        org_config['orgs']['tektoncd']['teams'][team_name] = team
+    return teams
+
+
+def normalize_team(team):
+    """ A team with its lists sorted, to compare teams regardless of order """
+    return {k: sorted(v) if isinstance(v, list) else v
+            for k, v in (team or {}).items()}
+
+
+def team_people(team):
+    team = team or {}
+    return set(team.get('maintainers', []) or []) | set(team.get('members', []) or [])
+
+
+def diff_teams(current, desired):
+    """ Find the desired teams that differ from the current ones
+
+    :returns: a dict of team names to the current and desired team and
+      the people added and removed
+    """
+    changes = {}
+    for team_name, team in desired.items():
+        old_team = current.get(team_name)
+        if normalize_team(old_team) == normalize_team(team):
+            continue
+        changes[team_name] = dict(
+            current=old_team, desired=team,
+            added=sorted(team_people(team) - team_people(old_team), key=str.lower),
+            removed=sorted(team_people(old_team) - team_people(team), key=str.lower))
+    return changes
+
+
+def print_changes(changes, with_diff):
+    yaml = YAML(typ='safe')
+    yaml.default_flow_style = False
+    for team_name, change in changes.items():
+        if with_diff:
+            dumps = []
+            for team in (change['current'], change['desired']):
+                team_io = io.StringIO()
+                if team is not None:
+                    yaml.dump({team_name: team}, team_io)
+                dumps.append(team_io.getvalue().splitlines(keepends=True))
+            sys.stdout.writelines(difflib.unified_diff(
+                *dumps, fromfile=f'current/{team_name}',
+                tofile=f'desired/{team_name}'))
+        print(f'{team_name}: +{len(change["added"])} {change["added"]} '
+              f'-{len(change["removed"])} {change["removed"]}')
+
+
+def update_team(team, desired):
+    """ Update a round trip loaded team in place
+
+    Lists keep the order and comments of the people already in the team,
+    people who joined are appended at the end.
+    """
+    for key, value in desired.items():
+        current = team.get(key)
+        if isinstance(value, list) and isinstance(current, list):
+            for person in [p for p in current if p not in value]:
+                current.remove(person)
+            current.extend(p for p in value if p not in current)
+        elif current != value:
+            team[key] = value
+
+
+def indentation(line):
+    return len(line) - len(line.lstrip(' '))
+
+
+def team_blocks(lines, org_teams):
+    """ returns the (start, end) lines of each team in the org config
+
+    A block ends at the next line that is indented like the team name,
+    blank lines and comments before it belong to the block, as they do
+    for the round trip loader.
+    """
+    blocks = {}
+    for team_name in org_teams:
+        start, column = org_teams.lc.key(team_name)
+        end = start + 1
+        while end < len(lines) and (
+                not lines[end].strip() or
+                lines[end].lstrip().startswith('#') or
+                indentation(lines[end]) > column):
+            end += 1
+        blocks[team_name] = (start, end)
+    return blocks
+
+
+def sequence_indent(lines):
+    """ returns the YAML.indent arguments for the sequences in a team """
+    for previous, line in zip(lines, lines[1:]):
+        if line.lstrip().startswith('- '):
+            offset = indentation(line) - indentation(previous)
+            if offset > 0:
+                return dict(mapping=2, sequence=2 + offset, offset=offset)
+            break
+    return SEQUENCE_INDENT
+
+
+def render_team(org, team_name, team, indent):
+    """ returns the lines of a round trip loaded team in the org config """
+    yaml = YAML()
+    yaml.preserve_quotes = True
+    yaml.indent(**indent)
+    team_io = io.StringIO()
+    # Dump the team at its depth in the config, comments keep their column
+    yaml.dump({'orgs': {org: {'teams': {team_name: team}}}}, team_io)
+    return team_io.getvalue().splitlines(True)[3:]
+
+
+def update_collaborator_teams(contributors, dry_run=False):
+    teams = desired_teams(contributors)
+
+    # Compare with the current teams, the safe loader is much faster than
+    # a round trip, which is only needed when the config is written back
+    logging.info(f'Loading org configuration from {ORG_CONFIG}')
+    with open(ORG_CONFIG, 'r') as org_config_file:
+        current = YAML(typ='safe').load(org_config_file)
+    changes = diff_teams(current['orgs']['tektoncd']['teams'], teams)
+    print_changes(changes, with_diff=dry_run)
+    if not changes:
+        logging.info('All collaborator teams are up to date')
+        return
+    if dry_run:
+        return
+
+    yaml = YAML()
+    yaml.preserve_quotes = True
+    with open(ORG_CONFIG, 'r') as org_config_file:
+        org_config_text = org_config_file.read()
+    org_config = yaml.load(org_config_text)
+
+    # Update the config with the collaborator teams that changed
+    org_teams = org_config['orgs']['tektoncd']['teams']
+    lines = org_config_text.splitlines(True)
+    blocks = team_blocks(lines, org_teams)
+    new_teams = []
+    for team_name in changes:
+        logging.info(f'Updating team {team_name}')
+        if team_name in org_teams:
+            update_team(org_teams[team_name], teams[team_name])
+        else:
+            org_teams[team_name] = teams[team_name]
+            new_teams.append(team_name)
+
+    # Only re-render the teams that changed, dumping the whole config
+    # would re-indent the teams that use a different sequence indentation
+    end = max(end for _, end in blocks.values())
+    lines[end:end] = [line for team_name in new_teams for line in render_team(
+        'tektoncd', team_name, org_teams[team_name], SEQUENCE_INDENT)]
+    for team_name, (start, end) in sorted(
+            blocks.items(), key=lambda b: b[1], reverse=True):
+        if team_name in changes:
+            lines[start:end] = render_team(
+                'tektoncd', team_name, org_teams[team_name],
+                sequence_indent(lines[start:end]))
 
     # Save the config back to disk
     logging.info(f'Saving org configuration to {ORG_CONFIG}')
     with open(ORG_CONFIG, 'w') as org_config_file:
-        yaml.dump(org_config, org_config_file)
+        org_config_file.write(''.join(lines))
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Update the collaborator teams in org.yaml')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='the number of repos to search in parallel')
+    parser.add_argument('--max-age', type=int, default=DEFAULT_MAX_AGE_DAYS,
+                        help='days after which cached repos are searched again')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='search all repos, without reading or writing the cache')
+    parser.add_argument('--api-url', default=GITHUB_API,
+                        help='the URL of the GitHub API')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the changes to the teams without saving them')
+    parser.add_argument('--backend', choices=BACKENDS, default='rest',
+                        help='the GitHub API used to fetch members, repos and teams')
+    args = parser.parse_args()
+
     github_token = os.getenv('GITHUB_TOKEN')
     if not github_token:
         logging.error('GITHUB_TOKEN must be set')
         sys.exit(1)
-    contributors = get_contributors_maintainers(github_token)
-    update_collaborator_teams(contributors)
+    if args.backend == 'graphql':
+        get_contributors = get_contributors_maintainers_graphql
+    else:
+        get_contributors = get_contributors_maintainers
+    contributors = get_contributors(
+        github_token, workers=args.workers,
+        cache_file=None if args.no_cache else ORG_CACHE,
+        max_age=args.max_age, base_url=args.api_url)
+    update_collaborator_teams(contributors, dry_run=args.dry_run)
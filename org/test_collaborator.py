@@ -0,0 +1,199 @@
+from http import server
+import json
+import os
+import shutil
+import threading
+
+import pytest
+from ruamel.yaml import YAML
+
+import collaborator
+
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+
+def load_testdata(filename):
+    with open(os.path.join(TESTDATA, filename), 'r') as testdata:
+        return json.load(testdata)
+
+
+class GitHubStub(server.BaseHTTPRequestHandler):
+    """ Serves the GraphQL and stats responses recorded in testdata
+
+    GraphQL responses are matched by the variables of the query, stats
+    responses are served in order, null for a 202 while GitHub computes
+    the stats and a number for an error status.
+    """
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])))
+        self.server.queries.append(request)
+        for exchange in self.server.graphql:
+            if exchange['variables'] == request['variables']:
+                return self.reply(200, exchange['response'])
+        self.reply(200, dict(errors=[dict(
+            message=f'No response for {request["variables"]}')]))
+
+    def do_GET(self):
+        path = self.path.split('/')
+        repo = path[3]
+        if len(path) == 4:
+            return self.reply(200, dict(
+                name=repo, full_name=f'tektoncd/{repo}',
+                url=f'http://127.0.0.1:{self.server.server_port}{self.path}'))
+        stats = self.server.stats.get(repo)
+        if not stats:
+            return self.reply(204, None)
+        body = stats.pop(0) if len(stats) > 1 else stats[0]
+        if body is None:
+            self.reply(202, None)
+        elif isinstance(body, int):
+            self.reply(body, dict(message='Server Error'))
+        else:
+            self.reply(200, body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def github(monkeypatch):
+    monkeypatch.setattr(collaborator.time, 'sleep', lambda delay: None)
+    stub = server.ThreadingHTTPServer(('127.0.0.1', 0), GitHubStub)
+    stub.graphql = load_testdata('graphql.json')
+    stub.stats = load_testdata('stats_contributors.json')
+    stub.queries = []
+    thread = threading.Thread(target=stub.serve_forever, daemon=True)
+    thread.start()
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+
+
+@pytest.fixture
+def org_config(tmp_path, monkeypatch):
+    org_config = tmp_path / 'org.yaml'
+    shutil.copy(collaborator.ORG_CONFIG, org_config)
+    monkeypatch.setattr(collaborator, 'ORG_CONFIG', str(org_config))
+    return org_config
+
+
+def without_teams(org_config_text, team_names):
+    """ returns the lines of the org config without some tektoncd teams """
+    lines = org_config_text.splitlines(True)
+    teams = YAML().load(org_config_text)['orgs']['tektoncd']['teams']
+    blocks = collaborator.team_blocks(lines, teams)
+    for team_name, (start, end) in sorted(
+            blocks.items(), key=lambda b: b[1], reverse=True):
+        if team_name in team_names:
+            del lines[start:end]
+    return lines
+
+
+def test_update_collaborator_teams_keeps_other_teams(org_config):
+    before = org_config.read_text()
+    teams = YAML(typ='safe').load(before)['orgs']['tektoncd']['teams']
+    people = teams['cli.collaborators']['members']
+    collaborator.update_collaborator_teams({
+        'cli': people[1:] + ['newcomer'],
+        'newrepo': ['someone'],
+    })
+    after = org_config.read_text()
+
+    teams = YAML(typ='safe').load(after)['orgs']['tektoncd']['teams']
+    assert 'newcomer' in teams['cli.collaborators']['members']
+    assert people[0] not in teams['cli.collaborators']['members']
+    assert teams['newrepo.collaborators']['members'] == ['someone']
+    # Only the two teams changed, the other teams keep their indentation
+    changed = ['cli.collaborators', 'newrepo.collaborators']
+    assert without_teams(after, changed) == without_teams(before, changed)
+
+
+def test_render_team_keeps_indentation():
+    yaml = YAML()
+    with open(collaborator.ORG_CONFIG, 'r') as org_config_file:
+        org_config_text = org_config_file.read()
+    lines = org_config_text.splitlines(True)
+    for org, config in yaml.load(org_config_text)['orgs'].items():
+        for team_name, (start, end) in collaborator.team_blocks(
+                lines, config['teams']).items():
+            assert collaborator.render_team(
+                org, team_name, config['teams'][team_name],
+                collaborator.sequence_indent(lines[start:end])
+            ) == lines[start:end], team_name
+
+
+def test_graphql_org_paginates_teams(github):
+    client = collaborator.GraphQLClient(
+        'token', base_url=f'http://127.0.0.1:{github.server_port}')
+    org = collaborator.graphql_org(
+        client, ['repos', 'teams', 'members'], page_size=2)
+
+    assert [x['name'] for x in org['repos']] == ['.github', 'cli', 'pipeline']
+    assert len(org['members']) == 3
+    teams = {team['name']: team for team in org['teams']}
+    assert sorted(teams) == [
+        'chains.maintainers', 'cli.maintainers', 'core.maintainers']
+    assert [x['name'] for x in teams['cli.maintainers']['repositories'][
+        'nodes']] == ['cli', 'homebrew-tools', 'plumbing', 'website']
+    assert [x['login'] for x in teams['core.maintainers']['members'][
+        'nodes']] == ['afrittoli', 'vdemeester', 'pritidesai']
+    assert all('first: 2' in query['query'] for query in github.queries)
+
+
+def test_get_contributors_maintainers_graphql(github, tmp_path):
+    cache_file = str(tmp_path / 'cache.json')
+    contributors = collaborator.get_contributors_maintainers_graphql(
+        'token', workers=2, cache_file=cache_file,
+        base_url=f'http://127.0.0.1:{github.server_port}', page_size=2)
+
+    assert contributors == {
+        'cli': {'chmouel'},
+        'pipeline': {'afrittoli'},
+        'community': {'afrittoli', 'chmouel', 'pritidesai', 'vdemeester'},
+    }
+    cache = collaborator.load_cache(cache_file)
+    assert sorted(cache['repos']) == ['cli', 'pipeline']
+    assert cache['repos']['pipeline']['maintainers'] == [
+        'afrittoli', 'vdemeester', 'pritidesai']
+
+
+def test_get_stats_contributors(github):
+    g = collaborator.github.Github(
+        'token', base_url=f'http://127.0.0.1:{github.server_port}')
+    github.stats['chains'] = [404]
+
+    cli = collaborator.get_stats_contributors(g.get_repo('tektoncd/cli'))
+    assert [x['author']['login'] for x in cli] == ['chmouel', 'outsider']
+    # Empty repos have no stats, they are not polled again
+    assert collaborator.get_stats_contributors(
+        g.get_repo('tektoncd/empty')) == []
+    assert not github.stats.get('empty')
+    with pytest.raises(collaborator.github.GithubException):
+        collaborator.get_stats_contributors(g.get_repo('tektoncd/chains'))
+
+
+def test_get_contributors_maintainers_graphql_failed_repo(github, tmp_path):
+    cache_file = str(tmp_path / 'cache.json')
+    github.stats['pipeline'] = [500]
+    contributors = collaborator.get_contributors_maintainers_graphql(
+        'token', workers=2, cache_file=cache_file,
+        base_url=f'http://127.0.0.1:{github.server_port}', page_size=2)
+
+    # The other repos are still searched and cached
+    assert contributors['cli'] == {'chmouel'}
+    assert contributors['pipeline'] == set()
+    cache = collaborator.load_cache(cache_file)
+    assert cache['repos']['cli']['date'] is not None
+    assert cache['repos']['pipeline']['date'] is None
+    assert collaborator.is_stale(cache['repos']['pipeline'], max_age=1)
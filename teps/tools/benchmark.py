@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 The Tekton Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script measures the performance of the TEP automation in teps.py
+
+from datetime import date, timedelta
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import click
+from click.testing import CliRunner
+
+import teps
+
+DEFAULT_SIZES = [150, 1000, 10000]
+STATUSES = ['proposed', 'implementable', 'implementing', 'implemented',
+            'deferred', 'withdrawn']
+# Body sizes of the TEPs in the repo range from ~3KB to ~30KB
+BODY_SIZES = (3 * 1024, 30 * 1024)
+# A mix of pattern kinds, with files in the TEP folder that match them
+GITIGNORE = [
+    '# editors and OS files',
+    '*.swp',
+    '*~',
+    '**/.DS_Store',
+    '.idea/',
+    '!keep.swp',
+    '/build',
+    './notes.md',
+    'docs/_build/*.html',
+    '*.py[cod]',
+    '.teps-cache.json',
+    '.teps-prs-cache.json',
+]
+IGNORED_FILES = ['draft.swp', 'keep.swp', 'README.md~', '.DS_Store',
+                 'notes.md', 'scratch.pyc']
+PARAGRAPH = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed '
+             'do eiusmod tempor incididunt ut labore et dolore magna aliqua. '
+             'Ut enim ad minim veniam, quis nostrud exercitation ullamco.\n\n')
+
+
+def parse_folder(teps_folder, with_body):
+    for tep_file in teps.teps_in_folder(teps_folder):
+        with open(os.path.join(teps_folder, tep_file), 'r') as tep_io:
+            teps.read_tep(tep_io, with_body=with_body, ignore_errors=True)
+
+
+def read_headers(teps_folder):
+    """ returns the YAML front matter of each TEP in the folder """
+    headers = []
+    for tep_file in teps.teps_in_folder(teps_folder):
+        with open(os.path.join(teps_folder, tep_file), 'r') as tep_io:
+            lines = tep_io.read().split(teps.YAML_SEPARATOR, 2)
+        if len(lines) == 3:
+            headers.append(lines[1])
+    return headers
+
+
+def report(name, timings, count):
+    best = min(timings)
+    print(f'{name:<24} best {best * 1000:8.2f} ms  '
+          f'per TEP {best / max(count, 1) * 1e6:8.1f} us')
+    return best
+
+
+def make_corpus(root, size, seed=0):
+    """ Write a synthetic TEP folder with size TEPs under root
+
+    TEP numbers only have four digits, so they wrap around past 9999.
+
+    :returns: the path of the TEP folder
+    """
+    rng = random.Random(seed)
+    teps_folder = os.path.join(root, 'teps')
+    os.makedirs(teps_folder)
+    with open(os.path.join(root, '.gitignore'), 'w') as gitignore:
+        gitignore.write('\n'.join(GITIGNORE) + '\n')
+    shutil.copy(os.path.join(teps.LOCAL_TEP_FOLDER, teps.README_TEMPLATE),
+                teps_folder)
+    for filename in IGNORED_FILES:
+        with open(os.path.join(teps_folder, filename), 'w') as ignored:
+            ignored.write('ignored\n')
+    created = date(2020, 3, 10)
+    for i in range(size):
+        number = i % 9999 + 1
+        tep = dict(title=f'Synthetic proposal {i}', number=number,
+                   authors=[f'author{rng.randrange(200)}'
+                            for _ in range(rng.randint(1, 3))],
+                   collaborators=[], status=rng.choice(STATUSES))
+        creation_date = created + timedelta(days=i % 1500)
+        tep['creation-date'] = str(creation_date)
+        tep['last-updated'] = str(creation_date + timedelta(
+            days=rng.randrange(365)))
+        body_size = rng.randint(*BODY_SIZES)
+        tep_filename = f'{number:04d}-synthetic-proposal-{i}.md'
+        with open(os.path.join(teps_folder, tep_filename), 'w') as tep_io:
+            teps.write_tep_header(tep, tep_io)
+            tep_io.write('\n')
+            tep_io.write(PARAGRAPH * (body_size // len(PARAGRAPH)))
+    return teps_folder
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, repeat=repeat, number=1))
+
+
+def time_stages(teps_folder, repeat, loader):
+    """ Time each stage of loading TEPs and rendering the table """
+    tep_files = sorted(teps.teps_in_folder(teps_folder))
+    tep_paths = [os.path.join(teps_folder, f) for f in tep_files]
+    parsed = [tep for tep, _ in teps.parse_tep_files(tep_paths, loader=loader)]
+    rows = dict(teps=sorted(
+        (dict(tep, lastupdated=tep.get('last-updated')) for tep in parsed),
+        key=lambda k: k.get('number')))
+    with open(os.path.join(teps_folder, teps.README_TEMPLATE), 'r') as template:
+        template = template.read()
+    return {
+        'listdir': best_of(lambda: [
+            f for f in os.listdir(teps_folder)
+            if os.path.isfile(os.path.join(teps_folder, f))], repeat),
+        'gitignore': best_of(
+            lambda: teps.get_excluded_filenames(teps_folder), repeat),
+        'header parse': best_of(
+            lambda: teps.parse_tep_files(tep_paths, loader=loader), repeat),
+        'sort': best_of(
+            lambda: sorted(rows['teps'], key=lambda k: k.get('number')),
+            repeat),
+        'render': best_of(
+            lambda: teps.update_tep_table(template, rows, ''), repeat),
+    }
+
+
+def time_commands(teps_folder, repeat, loader):
+    """ Time the commands of teps.py end to end """
+    runner = CliRunner()
+
+    def invoke(*args):
+        return lambda: runner.invoke(teps.teps, [
+            '--yaml-loader', loader, *args, '--teps-folder', teps_folder])
+
+    # An offline PR lookup without cached PRs, so GitHub is not queried
+    no_prs = teps.PullRequests(offline=True)
+    times = {'validate': best_of(invoke('--no-cache', 'validate'), repeat)}
+    # Fill the cache with an untimed run, so that only cached runs are timed
+    invoke('--cache', 'validate')()
+    times['validate (cached)'] = best_of(invoke('--cache', 'validate'), repeat)
+    return {
+        **times,
+        'table': best_of(invoke('--no-cache', 'table'), repeat),
+        'next_tep_number': best_of(lambda: teps.next_tep_number(
+            teps_folder, pull_requests=no_prs, cache=False, loader=loader),
+            repeat),
+        'get_excluded_filenames': best_of(
+            lambda: teps.get_excluded_filenames(teps_folder), repeat),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+            check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def benchmark():
+    pass
+
+
+@benchmark.command()
+@click.option('--teps-folder', default=teps.LOCAL_TEP_FOLDER,
+              help='the folder that contains the TEP files')
+@click.option('--repeat', '-r', default=5,
+              help='how many times to repeat each measurement')
+def headers(teps_folder, repeat):
+    """ Compare header-only TEP parsing against a full scan """
+    count = len(teps.teps_in_folder(teps_folder))
+    print(f'Parsing {count} TEPs from {teps_folder}')
+    full = report('full scan', timeit.repeat(
+        lambda: parse_folder(teps_folder, with_body=True),
+        repeat=repeat, number=1), count)
+    header = report('header only', timeit.repeat(
+        lambda: parse_folder(teps_folder, with_body=False),
+        repeat=repeat, number=1), count)
+    print(f'Speedup: {full / header:.1f}x')
+
+
+@benchmark.command()
+@click.option('--teps-folder', default=teps.LOCAL_TEP_FOLDER,
+              help='the folder that contains the TEP files')
+@click.option('--repeat', '-r', default=5,
+              help='how many times to repeat each measurement')
+def yaml(teps_folder, repeat):
+    """ Compare the per TEP header parse cost of each YAML loader """
+    headers = read_headers(teps_folder)
+    print(f'Loading {len(headers)} TEP headers from {teps_folder}')
+    for loader in teps.YAML_LOADERS:
+        yaml_loader = teps.get_yaml(loader)
+        report(f'{loader} ({yaml_loader.Parser.__name__})', timeit.repeat(
+            lambda: [yaml_loader.load(h) for h in headers],
+            repeat=repeat, number=1), len(headers))
+
+
+@benchmark.command()
+@click.option('--size', '-s', 'sizes', multiple=True, type=int,
+              default=DEFAULT_SIZES, show_default=True,
+              help='the number of TEPs in a synthetic TEP folder')
+@click.option('--repeat', '-r', default=3,
+              help='how many times to repeat each measurement')
+@click.option('--yaml-loader', default=teps.DEFAULT_YAML_LOADER,
+              type=click.Choice(list(teps.YAML_LOADERS)),
+              help='the YAML loader used to parse TEP headers')
+@click.option('--output', '-o', default=None,
+              help='the JSON file to save the results to')
+def suite(sizes, repeat, yaml_loader, output):
+    """ Time the commands and their stages over synthetic TEP folders """
+    # Synthetic TEPs have duplicate numbers past 9999, which is logged
+    logging.disable(logging.CRITICAL)
+    results = dict(commit=git_commit(), python=platform.python_version(),
+                   date=date.today().isoformat(), repeat=repeat,
+                   yaml_loader=yaml_loader, sizes={})
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as root:
+            teps_folder = make_corpus(root, size)
+            print(f'{size} synthetic TEPs')
+            result = dict(commands=time_commands(teps_folder, repeat, yaml_loader),
+                          stages=time_stages(teps_folder, repeat, yaml_loader))
+        for kind in ('commands', 'stages'):
+            for name, best in result[kind].items():
+                report(f'  {name}', [best], size)
+        results['sizes'][str(size)] = result
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f'Results saved to {output}')
+
+
+@benchmark.command()
+@click.argument('baseline', type=click.File('r'))
+@click.argument('current', type=click.File('r'))
+def compare(baseline, current):
+    """ Compare the results of two suite runs, e.g. across commits """
+    baseline, current = json.load(baseline), json.load(current)
+    print(f'{baseline["commit"] or "baseline"} -> '
+          f'{current["commit"] or "current"}')
+    for size, result in current['sizes'].items():
+        if size not in baseline['sizes']:
+            continue
+        print(f'{size} synthetic TEPs')
+        for kind in ('commands', 'stages'):
+            for name, best in result[kind].items():
+                before = baseline['sizes'][size][kind].get(name)
+                if before is None:
+                    continue
+                print(f'  {name:<24} {before * 1000:10.2f} ms '
+                      f'{best * 1000:10.2f} ms  {best / before:6.2f}x')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -21,18 +21,21 @@
 # This scripts provide automation for the TEPs
 
 from datetime import date
-import fnmatch
-import json
+import functools
+import glob
+import hashlib
 import logging
+import math
 import os
 import re
 import sys
-from urllib import parse
-from urllib import request
+import time
 
-import chevron
 import click
-from ruamel.yaml import YAML, YAMLError
+
+# chevron, ruamel.yaml, urllib, json and concurrent.futures are imported
+# by the functions that use them, so that commands start without loading
+# dependencies they do not need
 
 LOCAL_TEP_FOLDER = os.path.normpath(
     os.path.join(os.path.dirname(
@@ -43,9 +46,27 @@ TEP_TEMPLATE = os.path.normpath(
 
 README_TEMPLATE = 'README.md.mustache'
 README = 'README.md'
+# Metadata of parsed TEPs, persisted in the TEP folder between runs
+CACHE_FILENAME = '.teps-cache.json'
+CACHE_VERSION = 2
 PR_URL = 'https://api.github.com/repos/tektoncd/community/pulls'
 PR_HEADER = {'Accept': 'application/vnd.github.v3.full+json',
              'User-Agent': 'tekton-teps-client'}
+PR_PAGE_SIZE = 100
+# Longest wait for a rate limited request before falling back to the cache
+PR_MAX_RETRY_AFTER = 60
+# Pages of open PRs, persisted in the TEP folder between runs
+PR_CACHE_FILENAME = '.teps-prs-cache.json'
+# Keys of the rows of the TEPs table, persisted in the TEP folder between runs
+TABLE_CACHE_FILENAME = '.teps-table-cache.json'
+TABLE_CACHE_VERSION = 1
+# Full text index of the TEPs, persisted in the TEP folder between runs
+INDEX_FILENAME = '.teps-index.json'
+INDEX_VERSION = 1
+# Ranking parameters of the search, terms in the title weigh more
+INDEX_BM25_K1 = 1.2
+INDEX_BM25_B = 0.75
+INDEX_TITLE_WEIGHT = 5
 
 # File and body matches
 RE_TEP_NUMBER_TITLE = re.compile(r'^# (TEP-[0-9]{4}): .*$')
@@ -53,12 +74,32 @@ RE_TEP_NUMBER_FILENAME = re.compile(r'([0-9]{4})-.*.md')
 RE_TEP_NONUMBER_FILENAME = re.compile(r'([A-Za-z]{4})-.*.md')
 RE_TEP_4ALPHANUM_FILENAME = re.compile(r'[A-Za-z0-9]{4}-(.*.md)')
 RE_TEP_NUMBER_PR = re.compile(r'TEP[ -]([0-9]{4})')
+RE_LINK_NEXT = re.compile(r'<([^>]+)>;\s*rel="next"')
+RE_INDEX_TERM = re.compile(r'[a-z0-9]+')
+# README table matches
+RE_TEMPLATE_TABLE = re.compile(r'^{{#teps}}$.*^{{/teps}}$\n?',
+                               re.MULTILINE | re.DOTALL)
+RE_TABLE_ROW_LINK = re.compile(r'^\|\[[^]]*\]\(([^)]+)\)')
 YAML_SEPARATOR = '---\n'
+# Upper bound of bytes read when only the header of a TEP is needed
+HEADER_MAX_BYTES = 64 * 1024
+
+# YAML loaders for the TEP headers. 'safe' uses the C based loader when
+# ruamel.yaml.clib is installed and falls back to 'pure' otherwise.
+# 'rt' (round-trip) keeps comments and ordering, but it's the slowest.
+YAML_LOADERS = {'safe': dict(typ='safe'),
+                'pure': dict(typ='safe', pure=True),
+                'rt': dict(typ='rt')}
+DEFAULT_YAML_LOADER = 'safe'
 
 REQUIRED_FIELDS = ['title', 'authors', 'creation-date', 'status']
 EXCLUDED_FILENAMES = set(['README.md',
                           'README.md.mustache',
-                          'OWNERS'])
+                          'OWNERS',
+                          CACHE_FILENAME,
+                          PR_CACHE_FILENAME,
+                          TABLE_CACHE_FILENAME,
+                          INDEX_FILENAME])
 
 
 def load_gitignore_patterns(repo_root):
@@ -70,7 +111,12 @@ def load_gitignore_patterns(repo_root):
         try:
             with open(gitignore_path, 'r', encoding='utf-8') as f:
                 for line in f:
-                    line = line.strip()
+                    # Trailing spaces are ignored unless escaped
+                    line = line.rstrip('\r\n')
+                    stripped = line.rstrip(' ')
+                    if stripped.endswith('\\') and stripped != line:
+                        stripped += ' '
+                    line = stripped.lstrip()
                     # Skip empty lines and comments
                     if line and not line.startswith('#'):
                         patterns.append(line)
@@ -80,6 +126,131 @@ def load_gitignore_patterns(repo_root):
     return patterns
 
 
+def translate_gitignore_pattern(pattern):
+    """ returns a regex for the paths ignored by a gitignore pattern
+
+    Paths are relative to the folder of the .gitignore, with / separators.
+    A trailing '/' is dropped, compile_gitignore only applies such patterns
+    to folders.
+    """
+    # Patterns with a slash other than a trailing one are anchored to the
+    # .gitignore folder, others match at any level. './' is not special
+    # for git, it's treated as '/' for compatibility with older versions
+    # of this tool.
+    pattern = pattern.rstrip('/')
+    if pattern.startswith('./'):
+        pattern = pattern[1:]
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    regex = '' if anchored else '(?:.*/)?'
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i) and (i == 0 or pattern[i-1] == '/'):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i) and i + 2 == len(pattern) and (
+                i == 0 or pattern[i-1] == '/'):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        elif c == '[':
+            end = pattern.find(']', i + 2)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                chars = pattern[i+1:end].replace('\\', '\\\\')
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex += f'[{chars}]'
+                i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+
+def compile_gitignore(patterns):
+    """ returns a function that tells whether a path is ignored
+
+    Patterns are compiled into a regex for folders and one for files,
+    with one group per pattern in reverse order, so that the group that
+    matches is the last matching pattern, as in git. Paths ignored by a pattern are included
+    again when the last matching pattern is negated with '!', unless one
+    of their parent folders is ignored. Patterns with a trailing '/' only
+    match folders.
+    """
+    rules = []
+    for pattern in reversed(patterns):
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+        if not pattern.strip('/'):
+            continue
+        rules.append((translate_gitignore_pattern(pattern), negate,
+                      pattern.endswith('/')))
+    folder_ignored = gitignore_rules_matcher(rules)
+    file_ignored = gitignore_rules_matcher(
+        [rule for rule in rules if not rule[2]])
+
+    @functools.lru_cache(maxsize=None)
+    def parent_ignored(folder):
+        parent, _, _ = folder.rpartition('/')
+        return bool(parent) and parent_ignored(parent) or folder_ignored(folder)
+
+    def ignored(path):
+        parent, _, _ = path.rpartition('/')
+        return bool(parent) and parent_ignored(parent) or file_ignored(path)
+    return ignored
+
+
+def gitignore_rules_matcher(rules):
+    """ returns a function that tells whether a path is ignored
+
+    :param rules: a list of (regex, negate, directory), in reverse order
+    """
+    if not rules:
+        return lambda path: False
+    regex = re.compile('|'.join(f'({r})' for r, _, _ in rules), re.DOTALL)
+
+    def ignored(path):
+        match = regex.fullmatch(path)
+        return match is not None and not rules[match.lastindex - 1][1]
+    return ignored
+
+
+_gitignore_matchers = {}
+
+
+def gitignore_matcher(repo_root):
+    """ returns the compiled .gitignore of a folder
+
+    Matchers are memoized for as long as the .gitignore mtime and size
+    do not change.
+    """
+    gitignore_path = os.path.join(repo_root, '.gitignore')
+    try:
+        stat = os.stat(gitignore_path)
+        key = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        key = None
+    memo = _gitignore_matchers.get(gitignore_path)
+    if memo is None or memo[0] != key:
+        memo = (key, compile_gitignore(load_gitignore_patterns(repo_root)))
+        _gitignore_matchers[gitignore_path] = memo
+    return memo[1]
+
+
 def get_excluded_filenames(teps_folder):
     """Get all excluded filenames including gitignore patterns."""
     # Start with hardcoded excluded filenames
@@ -92,45 +263,31 @@ def get_excluded_filenames(teps_folder):
             break
         repo_root = os.path.dirname(repo_root)
     
-    # Load gitignore patterns
-    gitignore_patterns = load_gitignore_patterns(repo_root)
-    
-    # Check all files in the teps folder against gitignore patterns
+    # Check all files in the teps folder against gitignore patterns,
+    # with a single match of their path relative to the repository root
+    ignored = gitignore_matcher(repo_root)
+    prefix = os.path.relpath(teps_folder, repo_root).replace(os.sep, '/')
+    prefix = '' if prefix == '.' else prefix + '/'
     if os.path.exists(teps_folder):
-        for filename in os.listdir(teps_folder):
-            filepath = os.path.join(teps_folder, filename)
-            
-            # Skip directories
-            if not os.path.isfile(filepath):
-                continue
-                
-            # Check if file matches any gitignore pattern
-            for pattern in gitignore_patterns:
-                # Handle different gitignore pattern formats
-                if pattern.startswith('**/'):
-                    # Pattern like **/.DS_Store
-                    if fnmatch.fnmatch(filename, pattern[3:]):
-                        excluded.add(filename)
-                        break
-                elif pattern.startswith('./'):
-                    # Pattern like ./filename
-                    if fnmatch.fnmatch(filename, pattern[2:]):
-                        excluded.add(filename)
-                        break
-                elif '/' not in pattern:
-                    # Simple pattern like .DS_Store
-                    if fnmatch.fnmatch(filename, pattern):
-                        excluded.add(filename)
-                        break
-                else:
-                    # Pattern with path - check if the file matches
-                    if fnmatch.fnmatch(filename, os.path.basename(pattern)):
-                        excluded.add(filename)
-                        break
+        with os.scandir(teps_folder) as entries:
+            for entry in entries:
+                if entry.is_file() and ignored(prefix + entry.name):
+                    excluded.add(entry.name)
     
     return excluded
 
 
+_yaml_instances = {}
+
+
+def get_yaml(loader=DEFAULT_YAML_LOADER):
+    """ returns a YAML instance for the loader, shared across calls """
+    if loader not in _yaml_instances:
+        from ruamel.yaml import YAML
+        _yaml_instances[loader] = YAML(**YAML_LOADERS[loader])
+    return _yaml_instances[loader]
+
+
 class InvalidTep(Exception):
     pass
 
@@ -164,27 +321,44 @@ def write_tep_header(tep, tep_io):
         'creation-date': tep['creation-date'],
         'last-updated': tep.get('last-updated', tep['creation-date'])
     }
-    tep_header['authors'] = [f'@{a}' for a in tep['authors']]
-    tep_header['collaborators'] = [f'@{c}' for c in tep['collaborators']]
+    # Usernames parsed from existing TEPs already start with @
+    tep_header['authors'] = [f'@{a.lstrip("@")}' for a in tep['authors']]
+    tep_header['collaborators'] = [
+        f'@{c.lstrip("@")}' for c in tep.get('collaborators') or []]
+    if hasattr(tep, 'ca'):
+        # A header read with the rt loader: update it in place to keep
+        # its comments
+        header = tep.copy()
+        for key in [k for k in header if k not in tep_header]:
+            del header[key]
+        header.update(tep_header)
+        tep_header = header
     # First write the YAML header
     tep_io.write(YAML_SEPARATOR)
-    YAML().dump(tep_header, tep_io)
+    get_yaml('rt').dump(tep_header, tep_io)
     tep_io.write(YAML_SEPARATOR)
     # Then write the title
     tep_number = int(tep["number"])
     tep_io.write(f'\n# TEP-{tep_number:04d}: {tep_header["title"]}\n')
 
 
-def read_tep(tep_io, with_body=True, ignore_errors=False):
+def read_tep(tep_io, with_body=True, ignore_errors=False,
+             loader=DEFAULT_YAML_LOADER, timings=None):
     """ Read a TEP and validate its format
 
     :param tep: a TextIO with the TEP content and a name
-    :param with_body: whether to return the body
+    :param with_body: whether to return the body. When False, reading
+      stops as soon as the TEP title is found, or after HEADER_MAX_BYTES
     :param ignore_errors: return a tep dict even in case of errors
+    :param loader: the YAML_LOADERS entry used to parse the header
+    :param timings: a dict where to add the seconds spent loading the YAML
+      header and matching the title, as 'yaml' and 'title'
     :returns:  a tuple (header, body, list). If the tep is not valid, and
       ignore_errors==True, the list includes all Errors encountered.
     """
+    from ruamel.yaml import YAMLError
     issues = []
+    yaml_time = title_time = 0
 
     filename = os.path.normpath(tep_io.name)
     _, tep_name = os.path.split(filename)
@@ -201,7 +375,21 @@ def read_tep(tep_io, with_body=True, ignore_errors=False):
     section = ''
     header = []
     body = ''
-    for i, line in enumerate(tep_io):
+    bytes_left = HEADER_MAX_BYTES
+    too_large = False
+    while True:
+        if with_body:
+            line = tep_io.readline()
+        else:
+            # Lines are read with a bound too, so that a file without
+            # newlines is not read in full. A character is at least a byte.
+            line = tep_io.readline(bytes_left + 1)
+            bytes_left -= len(line.encode())
+            if bytes_left < 0:
+                too_large = True
+                break
+        if not line:
+            break
         # Try to match with all expected fields on this line
         if line == YAML_SEPARATOR and section == '':
             section = 'header'
@@ -209,12 +397,23 @@ def read_tep(tep_io, with_body=True, ignore_errors=False):
             header.append(line)
         elif line == YAML_SEPARATOR and section == 'header':
             section = 'body'
+            start = time.perf_counter()
             try:
-                tep.update(YAML().load('\n'.join(header)))
+                header_map = get_yaml(loader).load(''.join(header)) or {}
+                if hasattr(header_map, 'ca'):
+                    # Keep the round-trip mapping and its comments, so that
+                    # write_tep_header can write them back
+                    header_map.insert(0, 'link', tep['link'])
+                    tep = header_map
+                else:
+                    tep.update(header_map)
             except YAMLError as ye:
                 issues.append(InvalidTep(ye))
+            yaml_time += time.perf_counter() - start
         if section == 'body':
+            start = time.perf_counter()
             _match = RE_TEP_NUMBER_TITLE.match(line)
+            title_time += time.perf_counter() - start
             if _match:
                 key = 'number'
                 if tep.get(key):
@@ -222,6 +421,9 @@ def read_tep(tep_io, with_body=True, ignore_errors=False):
                         InvalidTepNumber(f'"{key}" found more than once in {filename}'))
                 else:
                     tep[key] = _match.groups()[0]
+                    if not with_body:
+                        # Header and title are all we need
+                        break
             else:
                 if with_body:
                     body += f'{line}'
@@ -229,7 +431,12 @@ def read_tep(tep_io, with_body=True, ignore_errors=False):
     # Some post-processing to handle missing fields
     tep_number = tep.get('number')
     tep_file_number = f'TEP-{tep_file_number:04d}' if tep_file_number is not None else 'TEP-XXXX'
-    if not tep_number:
+    if too_large:
+        issues.append(InvalidTep(
+            f'Header too large in {filename}, no TEP number title '
+            f'(# TEP-NNNN) in its first {HEADER_MAX_BYTES} bytes'))
+        tep['number'] = tep_file_number
+    elif not tep_number:
         issues.append(
             InvalidTepNumber(f'No TEP number title (# TEP-NNNN) in {filename}'))
         tep['number'] = tep_file_number
@@ -242,225 +449,1126 @@ def read_tep(tep_io, with_body=True, ignore_errors=False):
     if not tep.get('last-updated'):
         tep['last-updated'] = tep.get('creation-date')
 
+    if timings is not None:
+        timings['yaml'] = timings.get('yaml', 0) + yaml_time
+        timings['title'] = timings.get('title', 0) + title_time
+
     if issues and not ignore_errors:
         raise ValidationErrors(issues)
 
     return tep, body, issues
 
 
-def tep_from_file(tep_filename, with_body):
-    """ returns a TEP dict for valid input files or None """
-    with open(tep_filename, 'r') as tep_file:
-        tep, body, _ = read_tep(
-            tep_file, ignore_errors=False, with_body=with_body)
-    return tep, body
+ISSUE_TYPES = {'InvalidTep': InvalidTep,
+               'InvalidTepNumber': InvalidTepNumber}
+
+
+def encode_issues(issues):
+    """ returns issues as (type, message) pairs that can be serialized """
+    return [(type(i).__name__, str(i)) for i in issues]
+
+
+def decode_issues(issues):
+    """ returns the exceptions for a list of encoded issues """
+    return [ISSUE_TYPES.get(kind, InvalidTep)(message)
+            for kind, message in issues]
+
+
+def normalize_header(value):
+    """ returns a TEP header value with dates converted to strings
+
+    Dates in the YAML headers are loaded as date objects, they are stored
+    as strings so that TEPs from the cache and freshly parsed TEPs match.
+    """
+    if isinstance(value, date):
+        return str(value)
+    if isinstance(value, dict):
+        return {k: normalize_header(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [normalize_header(v) for v in value]
+    return value
+
+
+def parse_tep_file(tep_filename, loader=DEFAULT_YAML_LOADER, profile=False):
+    """ returns the TEP dict and encoded issues of a TEP header
 
+    This runs in worker processes when TEPs are parsed in parallel,
+    so it only returns values that can be pickled.
 
-def safe_tep_from_file(tep_filename):
-    """ returns a TEP dict for valid input files or None """
-    with open(tep_filename, 'r') as tep_file:
-        header, _, issues = read_tep(
-            tep_file, ignore_errors=True, with_body=False)
-    if issues:
-        logging.warning(f'{issues}')
-    return header
+    :param profile: whether to also return a dict with the seconds spent
+      parsing the TEP, as 'duration', 'yaml' and 'title'
+    """
+    if profile:
+        # Do not count the import of the YAML loader in the first TEP
+        get_yaml(loader)
+    start = time.perf_counter()
+    timings = {}
+    with open(tep_filename, 'r') as tep_io:
+        tep, _, issues = read_tep(
+            tep_io, with_body=False, ignore_errors=True, loader=loader,
+            timings=timings)
+    tep = normalize_header(tep)
+    if profile:
+        timings['duration'] = time.perf_counter() - start
+        return tep, encode_issues(issues), timings
+    return tep, encode_issues(issues)
+
+
+def parse_tep_files(tep_filenames, jobs=1, loader=DEFAULT_YAML_LOADER,
+                    profile=False):
+    """ returns parse_tep_file results in the order of tep_filenames """
+    parse = functools.partial(parse_tep_file, loader=loader, profile=profile)
+    if jobs > 1 and len(tep_filenames) > 1:
+        from concurrent import futures
+        chunksize = max(1, len(tep_filenames) // (jobs * 4))
+        with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(
+                parse, tep_filenames, chunksize=chunksize))
+    return [parse(f) for f in tep_filenames]
+
+
+class TepCache:
+    """ TepCache persists TEP metadata between runs
+
+    Entries are keyed by TEP filename and record the mtime and size of the
+    file they were parsed from. When the mtime or size of a TEP changed,
+    its content is hashed and the TEP is only parsed again if the hash
+    does not match the one of the entry. New entries are not hashed, so
+    that TEPs that are not cached yet are only read up to their title.
+    Entries for TEPs that were deleted or renamed are pruned on save. The
+    cache is discarded when TEPs are parsed with a different YAML loader.
+    """
 
+    def __init__(self, path, loader=DEFAULT_YAML_LOADER):
+        self.path = path
+        self.loader = loader
+        self.entries = {}
+        self.stats = {}
+        self.dirty = False
+        if not os.path.exists(path):
+            return
+        import json
+        try:
+            with open(path, 'r') as cache_file:
+                cache = json.load(cache_file)
+        except (IOError, ValueError) as e:
+            logging.warning(f'Ignoring invalid TEP cache {path}: {e}')
+            return
+        if (cache.get('version') == CACHE_VERSION and
+                cache.get('loader') == loader):
+            self.entries = cache.get('teps', {})
+
+    def get(self, teps_folder, tep_file):
+        """ returns the cached (TEP dict, encoded issues) or None """
+        tep_filename = os.path.join(teps_folder, tep_file)
+        stat = os.stat(tep_filename)
+        entry = self.entries.get(tep_file)
+        if (entry and entry['mtime'] == stat.st_mtime_ns and
+                entry['size'] == stat.st_size):
+            return entry['tep'], entry['issues']
+        self.stats[tep_file] = dict(
+            mtime=stat.st_mtime_ns, size=stat.st_size, hash=None)
+        if not entry:
+            return None
+        with open(tep_filename, 'rb') as tep_file_io:
+            digest = hashlib.sha256(tep_file_io.read()).hexdigest()
+        self.stats[tep_file]['hash'] = digest
+        if entry['hash'] == digest:
+            entry.update(self.stats.pop(tep_file))
+            self.dirty = True
+            return entry['tep'], entry['issues']
+        return None
+
+    def put(self, tep_file, tep, issues):
+        """ stores a TEP parsed after a cache miss from get """
+        self.entries[tep_file] = dict(
+            self.stats.pop(tep_file), tep=tep, issues=issues)
+        self.dirty = True
+
+    def save(self, tep_files):
+        """ drop entries not in tep_files and write the cache if changed """
+        for tep_file in set(self.entries) - set(tep_files):
+            del self.entries[tep_file]
+            self.dirty = True
+        if not self.dirty:
+            return
+        import json
+        try:
+            with open(self.path, 'w') as cache_file:
+                json.dump(dict(version=CACHE_VERSION, loader=self.loader,
+                               teps=self.entries), cache_file)
+        except IOError as e:
+            logging.warning(f'Could not write TEP cache {self.path}: {e}')
+        self.dirty = False
 
-def teps_in_folder(teps_folder):
+
+def teps_in_folder(teps_folder, timings=None):
+    """ returns the TEP files in a folder
+
+    :param timings: a dict where to add the seconds spent filtering files
+      with the .gitignore and listing the folder, as 'gitignore' and
+      'listing'
+    """
+    start = time.perf_counter()
     excluded_filenames = get_excluded_filenames(teps_folder)
-    return [f for f in os.listdir(teps_folder) if os.path.isfile(
+    gitignore = time.perf_counter()
+    tep_files = [f for f in os.listdir(teps_folder) if os.path.isfile(
         os.path.join(teps_folder, f)) and f not in excluded_filenames]
+    if timings is not None:
+        timings['gitignore'] = timings.get('gitignore', 0) + gitignore - start
+        timings['listing'] = (timings.get('listing', 0) +
+                              time.perf_counter() - gitignore)
+    return tep_files
+
+
+def load_teps(teps_folder, cache=True, jobs=1, loader=DEFAULT_YAML_LOADER,
+              profile=None):
+    """ returns a list of (filename, TEP dict, issues) for a TEP folder
+
+    The list is sorted by filename, regardless of how TEPs are parsed.
+
+    :param teps_folder: the folder that contains the TEP files
+    :param cache: whether to reuse and update the metadata cache
+    :param jobs: how many processes to use to parse TEPs
+    :param loader: the YAML_LOADERS entry used to parse TEP headers
+    :param profile: a dict where to add the seconds spent in each stage as
+      'stages', and how each TEP was loaded as 'teps', a dict of filename
+      to dict(parse='cached' or 'parsed', duration, yaml, title)
+    """
+    stages = {}
+    tep_files = sorted(teps_in_folder(teps_folder, timings=stages))
+    tep_cache = None
+    if cache:
+        tep_cache = TepCache(os.path.join(teps_folder, CACHE_FILENAME),
+                             loader=loader)
+    parsed = {}
+    for tep_file in tep_files:
+        if tep_cache:
+            cached = tep_cache.get(teps_folder, tep_file)
+            if cached:
+                parsed[tep_file] = cached
+    missing = [f for f in tep_files if f not in parsed]
+    results = parse_tep_files(
+        [os.path.join(teps_folder, f) for f in missing], jobs=jobs,
+        loader=loader, profile=profile is not None)
+    timings = {}
+    for tep_file, (tep, issues, *tep_timings) in zip(missing, results):
+        if tep_cache:
+            tep_cache.put(tep_file, tep, issues)
+        parsed[tep_file] = (tep, issues)
+        if tep_timings:
+            timings[tep_file] = dict(parse='parsed', **tep_timings[0])
+    if tep_cache:
+        tep_cache.save(tep_files)
+    if profile is not None:
+        # Parsing time is summed over all jobs
+        for stage in ('yaml', 'title'):
+            stages.setdefault(stage, 0)
+            for timing in timings.values():
+                stages[stage] = stages.get(stage, 0) + timing.get(stage, 0)
+        profile.setdefault('stages', {}).update(stages)
+        profile['teps'] = {
+            f: timings.get(f, dict(parse='cached', duration=0))
+            for f in tep_files}
+    return [(f, parsed[f][0], decode_issues(parsed[f][1]))
+            for f in tep_files]
+
+
+class TepIndex:
+    """ TepIndex is a full text index of the TEPs, persisted between runs
+
+    Postings map each term to the TEPs that contain it and the positions
+    of the term in the TEP title and body. Positions are stored as strings
+    and only decoded for the terms of a query, which keeps loading the
+    index fast. The header fields used to show and filter results are
+    stored with each TEP, so that searches do not read any TEP file. TEPs
+    are indexed again only if their mtime or size changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.teps = {}
+        self.postings = {}
+        if not os.path.exists(path):
+            return
+        import json
+        try:
+            with open(path, 'r') as index_file:
+                index = json.load(index_file)
+        except (IOError, ValueError) as e:
+            logging.warning(f'Ignoring invalid TEP index {path}: {e}')
+            return
+        if index.get('version') == INDEX_VERSION:
+            self.teps = index['teps']
+            self.postings = index['postings']
+
+    def _remove(self, tep_files):
+        for tep_file in tep_files:
+            del self.teps[tep_file]
+        for term in list(self.postings):
+            postings = self.postings[term]
+            for tep_file in tep_files:
+                postings.pop(tep_file, None)
+            if not postings:
+                del self.postings[term]
+
+    def _positions(self, term, tep_file):
+        return [int(p) for p in self.postings[term][tep_file].split()]
+
+    def update(self, teps_folder, loader=DEFAULT_YAML_LOADER):
+        """ index the TEPs that changed and drop the ones that were removed
+
+        :returns: a tuple (number of TEPs indexed, number of TEPs removed)
+        """
+        tep_files = set(teps_in_folder(teps_folder))
+        removed = [f for f in self.teps if f not in tep_files]
+        changed = []
+        for tep_file in sorted(tep_files):
+            stat = os.stat(os.path.join(teps_folder, tep_file))
+            entry = self.teps.get(tep_file)
+            if (not entry or entry['mtime'] != stat.st_mtime_ns or
+                    entry['size'] != stat.st_size):
+                changed.append((tep_file, stat))
+        self._remove(removed + [f for f, _ in changed if f in self.teps])
+        for tep_file, stat in changed:
+            tep_filename = os.path.join(teps_folder, tep_file)
+            with open(tep_filename, 'r') as tep_io:
+                tep, body, _ = read_tep(
+                    tep_io, ignore_errors=True, loader=loader)
+            terms = {}
+            title = RE_INDEX_TERM.findall(str(tep.get('title') or '').lower())
+            body = RE_INDEX_TERM.findall(body.lower())
+            for position, term in enumerate(title + body):
+                terms.setdefault(term, []).append(str(position))
+            for term, positions in terms.items():
+                self.postings.setdefault(term, {})[tep_file] = ' '.join(
+                    positions)
+            self.teps[tep_file] = {
+                'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+                'number': tep.get('number'), 'title': tep.get('title'),
+                'status': tep.get('status'),
+                'creation-date': tep.get('creation-date'),
+                'last-updated': tep.get('last-updated'),
+                'title-length': len(title), 'length': len(title) + len(body)}
+        return len(changed), len(removed)
+
+    def save(self):
+        import json
+        with open(self.path, 'w') as index_file:
+            # default=str serializes dates from the YAML headers
+            json.dump(dict(version=INDEX_VERSION, teps=self.teps,
+                           postings=self.postings), index_file, default=str)
+
+    def search(self, query, statuses=(), since=None, until=None):
+        """ returns the TEPs that contain all the terms in the query
+
+        TEPs are ranked with BM25, where terms in the title count
+        INDEX_TITLE_WEIGHT times. TEPs where the terms appear next to each
+        other in the order of the query rank first.
+
+        :param query: the text to search
+        :param statuses: only return TEPs with one of these statuses
+        :param since: only return TEPs last updated on or after this date
+        :param until: only return TEPs last updated on or before this date
+        :returns: a list of (score, filename, TEP dict), best first
+        """
+        terms = RE_INDEX_TERM.findall(query.lower())
+        if not terms or any(term not in self.postings for term in terms):
+            return []
+        average_length = sum(
+            tep['length'] for tep in self.teps.values()) / len(self.teps)
+        results = []
+        tep_files = set.intersection(*(set(self.postings[t]) for t in terms))
+        for tep_file in tep_files:
+            tep = self.teps[tep_file]
+            if statuses and (tep['status'] or '').strip() not in statuses:
+                continue
+            updated = str(tep['last-updated'] or '')
+            if ((since and updated < str(since)) or
+                    (until and updated > str(until))):
+                continue
+            positions = [self._positions(t, tep_file) for t in terms]
+            norm = INDEX_BM25_K1 * (1 - INDEX_BM25_B + INDEX_BM25_B *
+                                    tep['length'] / average_length)
+            score = 0
+            for term, term_positions in zip(terms, positions):
+                tf = len(term_positions) + (INDEX_TITLE_WEIGHT - 1) * len(
+                    [p for p in term_positions if p < tep['title-length']])
+                documents = len(self.postings[term])
+                idf = math.log(1 + (len(self.teps) - documents + 0.5) /
+                               (documents + 0.5))
+                score += idf * tf * (INDEX_BM25_K1 + 1) / (tf + norm)
+            # Phrase matches, starting at the positions of the first term
+            following = [set(p) for p in positions[1:]]
+            if following and any(
+                    all(start + i + 1 in f for i, f in enumerate(following))
+                    for start in positions[0]):
+                score *= 2
+            results.append((score, tep_file, tep))
+        return sorted(results, key=lambda r: (-r[0], r[1]))
+
+
+class PullRequests:
+    """ PullRequests lists the titles of the open PRs in the community repo
+
+    All the pages of results are fetched, following the Link headers.
+    Pages are cached on disk with their ETag and requested again with
+    If-None-Match, so that pages that did not change are served from the
+    cache. The cache is also used when offline, when GitHub cannot be
+    reached or when the rate limit is exhausted.
+
+    :param url: the GitHub API URL of the pull requests
+    :param cache_filename: the file used to cache the pages, if any
+    :param offline: whether to only use the cache
+    :param token: a GitHub token, to get a higher rate limit
+    """
+
+    def __init__(self, url=PR_URL, cache_filename=None, offline=False,
+                 token=None):
+        self.url = f'{url}?state=open&per_page={PR_PAGE_SIZE}'
+        self.cache_filename = cache_filename
+        self.offline = offline
+        self.token = token
+        self.rate_limited = False
+        self.pages = {}
+        if cache_filename and os.path.exists(cache_filename):
+            import json
+            try:
+                with open(cache_filename, 'r') as cache_file:
+                    self.pages = json.load(cache_file)
+            except (IOError, ValueError) as e:
+                logging.warning(
+                    f'Ignoring invalid PR cache {cache_filename}: {e}')
+
+    def _request(self, url, cached):
+        import json
+        from urllib import request
+        headers = dict(PR_HEADER)
+        if self.token:
+            headers['Authorization'] = f'token {self.token}'
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        with request.urlopen(request.Request(url, headers=headers)) as response:
+            if response.headers.get('X-RateLimit-Remaining') == '0':
+                self.rate_limited = True
+            prs = json.loads(response.read())
+            link = RE_LINK_NEXT.search(response.headers.get('Link', ''))
+            return dict(etag=response.headers.get('ETag'),
+                        next=link.groups()[0] if link else None,
+                        titles=[pr['title'] for pr in prs])
+
+    def _retry_after(self, http_error):
+        """ returns seconds to wait for a rate limited request, or None """
+        if http_error.code not in (403, 429):
+            return None
+        retry_after = http_error.headers.get('Retry-After')
+        if retry_after is None:
+            if http_error.headers.get('X-RateLimit-Remaining') != '0':
+                return None
+            reset = int(http_error.headers.get('X-RateLimit-Reset', 0))
+            retry_after = max(0, reset - int(time.time()))
+        return int(retry_after)
+
+    def _page(self, url):
+        """ returns a page of results as dict(etag, next, titles) """
+        from urllib import error
+        cached = self.pages.get(url)
+        if self.offline or self.rate_limited:
+            return cached
+        for _ in range(2):
+            try:
+                return self._request(url, cached)
+            except error.HTTPError as e:
+                if e.code == 304 and cached:
+                    return cached
+                retry_after = self._retry_after(e)
+                if retry_after is None:
+                    raise
+                if retry_after > PR_MAX_RETRY_AFTER or cached:
+                    logging.warning(f'GitHub rate limit exceeded, '
+                                    f'resets in {retry_after}s')
+                    self.rate_limited = True
+                    return cached
+                time.sleep(retry_after)
+            except error.URLError as e:
+                if cached is None:
+                    raise
+                logging.warning(f'Could not reach GitHub ({e.reason}), '
+                                f'using cached PRs')
+                self.offline = True
+                return cached
+        self.rate_limited = True
+        return cached
+
+    def titles(self):
+        """ returns the titles of all open PRs """
+        titles = []
+        pages = {}
+        url = self.url
+        while url:
+            page = self._page(url)
+            if page is None:
+                logging.warning(f'No cached PRs for {url}, TEP numbers '
+                                f'used by open PRs may be missing')
+                break
+            pages[url] = page
+            titles.extend(page['titles'])
+            url = page['next']
+        if self.cache_filename and pages != self.pages:
+            import json
+            self.pages = pages
+            try:
+                with open(self.cache_filename, 'w') as cache_file:
+                    json.dump(self.pages, cache_file)
+            except IOError as e:
+                logging.warning(f'Could not write PR cache '
+                                f'{self.cache_filename}: {e}')
+        return titles
+
+
+def next_tep_number(teps_folder, pull_requests=None, cache=True, jobs=1,
+                    loader=DEFAULT_YAML_LOADER):
+    """ returns the next TEP number available
+
+    :param teps_folder: the folder that contains the TEP files
+    :param pull_requests: the PullRequests whose TEP numbers are in use,
+      by default the open PRs in the community repo
+    """
+    return next_tep_numbers(teps_folder, 1, pull_requests=pull_requests,
+                            cache=cache, jobs=jobs, loader=loader)[0]
+
+
+def next_tep_numbers(teps_folder, count, pull_requests=None, cache=True,
+                     jobs=1, loader=DEFAULT_YAML_LOADER):
+    """ returns a block of count contiguous TEP numbers available
 
+    The TEPs in the folder and the open PRs are only looked up once,
+    regardless of count.
 
-def next_tep_number(teps_folder):
-    tep_files = teps_in_folder(teps_folder)
+    :param teps_folder: the folder that contains the TEP files
+    :param count: how many TEP numbers to return
+    :param pull_requests: the PullRequests whose TEP numbers are in use,
+      by default the open PRs in the community repo
+    """
+    if pull_requests is None:
+        pull_requests = PullRequests(cache_filename=os.path.join(
+            teps_folder, PR_CACHE_FILENAME) if cache else None)
     tep_numbers = set()
     # Get all tep numbers from local files
-    for tep_file in tep_files:
-        tep = safe_tep_from_file(os.path.join(teps_folder, tep_file))
-        if tep:
-            tep_numbers.add(tep['number'])
+    for _, tep, issues in load_teps(
+            teps_folder, cache=cache, jobs=jobs, loader=loader):
+        if issues:
+            logging.warning(f'{issues}')
+        tep_numbers.add(tep['number'])
     # Get all tep numbers from open PRs
     # Assuming the PR title starts with TEP-
-    prs_request = request.Request(PR_URL, headers=PR_HEADER)
-    with request.urlopen(prs_request) as prs_response:
-        prs = json.loads(prs_response.read())
-    for pr in prs:
-        title = pr['title']
+    for title in pull_requests.titles():
         match = RE_TEP_NUMBER_PR.match(title)
         if match:
             number = match.groups()[0]
             tep_numbers.add(f'TEP-{number}')
+    last = 0
     for tep_number in sorted(tep_numbers, reverse=True):
         try:
             last = int(tep_number.split('-')[1])
-            return last+1
+            break
         except ValueError:
             continue
-    return 1
+    return list(range(last + 1, last + 1 + count))
+
 
+def write_teps(teps_folder, teps, modes=None):
+    """ Write several TEP files, all of them or none
 
-def generate_tep_table(teps_folder):
+    Each TEP is written to a temporary file first, and the temporary files
+    are only renamed to their target once all of them were written.
+
+    :param teps_folder: the folder that contains the TEP files
+    :param teps: a dict of TEP filenames to their content
+    :param modes: a dict of TEP filenames to their file mode. TEPs not
+      in it get the mode of new files, 0o666 without the umask bits
+    """
+    import tempfile
+    # Temporary files are only readable by their owner, the umask can
+    # only be read by setting it
+    umask = os.umask(0)
+    os.umask(umask)
+    modes = modes or {}
+    written = {}
+    try:
+        for tep_filename, content in teps.items():
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=teps_folder, prefix=f'.{tep_filename}.',
+                    suffix='.tmp', delete=False) as tep_io:
+                written[tep_filename] = tep_io.name
+                tep_io.write(content)
+            os.chmod(tep_io.name, modes.get(tep_filename, 0o666 & ~umask))
+    except BaseException:
+        for temporary in written.values():
+            os.remove(temporary)
+        raise
+    for tep_filename, temporary in written.items():
+        os.replace(temporary, os.path.join(teps_folder, tep_filename))
+
+
+def tep_content(tep, body):
+    """ returns the content of a TEP file with the header of a TEP dict """
+    import io
+    tep_io = io.StringIO()
+    write_tep_header(tep, tep_io)
+    tep_io.write(body)
+    return tep_io.getvalue()
+
+
+def tep_filenames(teps_folder, patterns):
+    """ returns the TEP filenames in a folder that match glob patterns
+
+    Patterns without wildcards are returned as they are, so that
+    missing files are reported when they are read.
+    """
+    filenames = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(os.path.basename(f) for f in glob.glob(
+                os.path.join(teps_folder, pattern)))
+            if not matches:
+                logging.warning(f'No TEP matches {pattern}')
+        else:
+            matches = [pattern]
+        filenames.extend(f for f in matches if f not in filenames)
+    return filenames
+
+
+def github_pull_requests(teps_folder, offline, cache):
+    """ returns the PullRequests used by the CLI commands """
+    return PullRequests(
+        cache_filename=os.path.join(teps_folder, PR_CACHE_FILENAME)
+        if cache or offline else None,
+        offline=offline, token=os.getenv('GITHUB_TOKEN'))
+
+
+def generate_tep_table(teps_folder, cache=True, jobs=1,
+                       loader=DEFAULT_YAML_LOADER):
+    loaded = load_teps(teps_folder, cache=cache, jobs=jobs, loader=loader)
+    for _, _, issues in loaded:
+        if issues:
+            logging.warning(f'{issues}')
+    write_tep_table(teps_folder, loaded, cache=cache)
+
+
+def write_tep_table(teps_folder, loaded, cache=True):
+    """ Update the table of TEPs in the README, if it changed
+
+    :param teps_folder: the folder that contains the TEP files
+    :param loaded: a list of (filename, TEP dict, issues) as from load_teps
+    :param cache: whether to reuse the rows of the current table, according
+      to the keys of the rows in TABLE_CACHE_FILENAME
+    :returns: whether the README was written
+    """
     teps = dict(teps = [])
-    tep_files = teps_in_folder(teps_folder)
-    for tep_file in tep_files:
-        tep = safe_tep_from_file(os.path.join(teps_folder, tep_file))
-        if tep:
-            # mustache doesn't link variables with a dash
-            tep['lastupdated'] = tep['last-updated']
-            teps['teps'].append(tep)
+    for _, tep, _ in loaded:
+        # mustache doesn't link variables with a dash
+        tep['lastupdated'] = tep['last-updated']
+        teps['teps'].append(tep)
 
     # Sort by TEP number
     teps['teps'] = sorted(teps['teps'], key=lambda k: k['number'])
     with open(os.path.join(teps_folder, README_TEMPLATE), 'r') as template:
-        with open(os.path.join(teps_folder, README), 'w+') as readme:
-            readme.write(chevron.render(template, teps))
+        template = template.read()
+    readme_filename = os.path.join(teps_folder, README)
+    current = ''
+    if os.path.exists(readme_filename):
+        with open(readme_filename, 'r') as readme:
+            current = readme.read()
+    rows_cache = None
+    if cache:
+        rows_cache = load_table_cache(
+            os.path.join(teps_folder, TABLE_CACHE_FILENAME))
+        cached_rows = dict(rows_cache)
+    updated, rendered = update_tep_table(template, teps, current, rows_cache)
+    if cache and rows_cache != cached_rows:
+        save_table_cache(
+            os.path.join(teps_folder, TABLE_CACHE_FILENAME), rows_cache)
+    if updated == current:
+        logging.info(f'{readme_filename} is up to date')
+        return False
+    logging.info(f'Updating {readme_filename}: {rendered} of '
+                 f'{len(teps["teps"])} TEP rows rendered')
+    with open(readme_filename, 'w+') as readme:
+        readme.write(updated)
+    return True
+
+
+def table_row_key(row_template, tep, row):
+    """ returns a key for a row of the TEPs table and what it's made of """
+    import json
+    return hashlib.sha256(json.dumps(
+        [row_template, tep, row], sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def load_table_cache(path):
+    """ returns the keys of the rows of the TEPs table saved in path """
+    if not os.path.exists(path):
+        return {}
+    import json
+    try:
+        with open(path, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError) as e:
+        logging.warning(f'Ignoring invalid table cache {path}: {e}')
+        return {}
+    if cache.get('version') != TABLE_CACHE_VERSION:
+        return {}
+    return cache.get('rows', {})
+
+
+def save_table_cache(path, rows_cache):
+    import json
+    try:
+        with open(path, 'w') as cache_file:
+            json.dump(dict(version=TABLE_CACHE_VERSION, rows=rows_cache),
+                      cache_file)
+    except IOError as e:
+        logging.warning(f'Could not write table cache {path}: {e}')
+
+
+def update_tep_table(template, teps, current, rows_cache=None):
+    """ Update the TEP table in a README rendered from the template
+
+    Rows of the current table are reused for the TEPs whose row key in
+    rows_cache matches their data, the row template and the row itself.
+    Only the rows of new or changed TEPs are rendered, and rows of removed
+    TEPs are dropped. When the text around the table does not match the
+    template, all rows are rendered, so that the result is always the same
+    as rendering the whole template.
+
+    :param template: the mustache template of the README
+    :param teps: a dict with the sorted list of TEPs to render
+    :param current: the content of the current README
+    :param rows_cache: a dict of TEP link to the key of its row, updated
+      for the rows of the new table. None to render the whole template
+    :returns: a tuple (README, number of rows rendered)
+    """
+    import chevron
+    table = RE_TEMPLATE_TABLE.search(template)
+    if rows_cache is None or not table:
+        return chevron.render(template, teps), len(teps['teps'])
+    row_template = table.group(0)
+    head = chevron.render(template[:table.start()], teps)
+    tail = chevron.render(template[table.end():], teps)
+    current_rows = {}
+    if (current.startswith(head) and current.endswith(tail) and
+            len(current) >= len(head) + len(tail)):
+        for row in current[len(head):len(current)-len(tail)].splitlines(True):
+            link = RE_TABLE_ROW_LINK.search(row)
+            if link:
+                current_rows[link.groups()[0]] = row
+    rows = []
+    rendered = 0
+    for tep in teps['teps']:
+        row = current_rows.get(tep['link'])
+        key = row and table_row_key(row_template, tep, row)
+        if row is None or rows_cache.get(tep['link']) != key:
+            row = chevron.render(row_template, dict(teps=[tep]))
+            key = table_row_key(row_template, tep, row)
+            rendered += 1
+        rows_cache[tep['link']] = key
+        rows.append(row)
+    for link in set(rows_cache) - set(tep['link'] for tep in teps['teps']):
+        del rows_cache[link]
+    return head + ''.join(rows) + tail, rendered
+
+
+def snapshot_teps(teps_folder):
+    """ returns the mtime and size of each TEP in a folder """
+    snapshot = {}
+    for tep_file in teps_in_folder(teps_folder):
+        try:
+            stat = os.stat(os.path.join(teps_folder, tep_file))
+        except OSError:
+            # Removed since the folder was listed
+            continue
+        snapshot[tep_file] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+def watch_teps(teps_folder, interval, debounce):
+    """ yields the TEPs (changed, removed) in a folder, as they change
+
+    The folder is polled every interval seconds. Once a change is seen,
+    changes are collected until the folder stays unchanged for debounce
+    seconds, so that bursts of writes from editors are reported once.
+    """
+    previous = snapshot_teps(teps_folder)
+    while True:
+        time.sleep(interval)
+        current = snapshot_teps(teps_folder)
+        if current == previous:
+            continue
+        while True:
+            time.sleep(debounce)
+            latest = snapshot_teps(teps_folder)
+            if latest == current:
+                break
+            current = latest
+        changed = sorted(f for f in current if previous.get(f) != current[f])
+        removed = sorted(set(previous) - set(current))
+        previous = current
+        yield changed, removed
 
 
 @click.group()
-def teps():
-    pass
+@click.option('--cache/--no-cache', default=True,
+              help='whether to reuse TEP metadata parsed in previous runs')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1),
+              help='the number of processes used to parse TEPs')
+@click.option('--yaml-loader', default=DEFAULT_YAML_LOADER,
+              type=click.Choice(list(YAML_LOADERS)),
+              help='the YAML loader used to parse TEP headers')
+@click.pass_context
+def teps(ctx, cache, jobs, yaml_loader):
+    ctx.obj = dict(cache=cache, jobs=jobs, loader=yaml_loader)
 
 
 @teps.command()
 @click.option('--teps-folder', default=LOCAL_TEP_FOLDER,
               help='the folder that contains the TEP files')
-def table(teps_folder):
+@click.pass_obj
+def table(options, teps_folder):
     """ Generate a table of TEPs from the teps in a folder """
     if not os.path.isdir(teps_folder):
         logging.error(f'Invalid TEP folder {teps_folder}: folder could not be found')
         sys.exit(1)
-    generate_tep_table(teps_folder)
+    generate_tep_table(teps_folder, **options)
+
+
+def tep_errors(tep_file, tep, issues):
+    """ returns the errors of a parsed TEP, from parsing or missing fields
+
+    Each issue and each missing field is a separate error.
+    """
+    return list(issues) + [
+        InvalidTep(f'{field} missing in {tep_file}')
+        for field in REQUIRED_FIELDS if tep.get(field, None) is None]
 
 
 @teps.command()
 @click.option('--teps-folder', default=LOCAL_TEP_FOLDER,
               help='the folder that contains the TEP files')
-def validate(teps_folder):
+@click.option('--format', 'output_format', default='text',
+              type=click.Choice(['text', 'json']),
+              help='the format of the validation results')
+@click.option('--profile', is_flag=True, default=False,
+              help='report the time spent in each stage and the slowest TEPs')
+@click.option('--slowest', default=5, type=click.IntRange(min=0),
+              help='the number of slowest TEPs reported by --profile')
+@click.pass_obj
+def validate(options, teps_folder, output_format, profile, slowest):
     """ Validate all the TEPs in a tep """
     if not os.path.isdir(teps_folder):
         logging.error(f'Invalid TEP folder {teps_folder}')
         sys.exit(1)
+    start = time.perf_counter()
     errors =[]
-    tep_numbers = set()
-    tep_files = teps_in_folder(teps_folder)
-
-    for tep_file in tep_files:
-        try:
-            tep, _ = tep_from_file(
-                os.path.join(teps_folder, tep_file), with_body=False)
-            for field in REQUIRED_FIELDS:
-                if tep.get(field, None) is None:
-                    errors.append(InvalidTep(f'{field} missing in {tep_file}'))
+    tep_numbers = {}
+    timings = {}
+    results = []
+
+    loaded = load_teps(teps_folder, profile=timings, **options)
+    duplicates_start = time.perf_counter()
+    for tep_file, tep, issues in loaded:
+        tep_issues = tep_errors(tep_file, tep, issues)
+        if not issues:
             number = tep.get('number', '')
             if number in tep_numbers:
-                errors.append(InvalidTepNumber(f'{tep_file} uses {number} which was already in use'))
-        except ValidationErrors as ve:
-            errors.append(ve)
+                tep_issues.append(InvalidTepNumber(
+                    f'{tep_file} uses {number} which was already in use '
+                    f'by {tep_numbers[number]}'))
+            else:
+                tep_numbers[number] = tep_file
+        errors.extend(tep_issues)
+        results.append(dict(
+            file=tep_file, number=tep.get('number'),
+            parse=timings['teps'][tep_file]['parse'],
+            duration=timings['teps'][tep_file]['duration'],
+            issues=[str(e) for e in tep_issues]))
+    stages = timings['stages']
+    stages['duplicates'] = time.perf_counter() - duplicates_start
+    duration = time.perf_counter() - start
+    slowest_teps = sorted(results, key=lambda r: -r['duration'])[:slowest]
+
+    if output_format == 'json':
+        import json
+        report = dict(valid=not errors, duration=duration, teps=results)
+        if profile:
+            report['profile'] = dict(
+                stages=stages,
+                slowest=[dict(file=r['file'], duration=r['duration'])
+                         for r in slowest_teps])
+        print(json.dumps(report, indent=2))
+    else:
+        if errors:
+            logging.error('\n'.join([str(e) for e in errors]))
+        if profile:
+            print(f'Validated {len(results)} TEPs in {duration * 1000:.2f} ms')
+            for stage, seconds in stages.items():
+                print(f'  {stage:<12} {seconds * 1000:8.2f} ms')
+            print('Slowest TEPs:')
+            for r in slowest_teps:
+                print(f'  {r["file"]:<60} {r["duration"] * 1000:8.2f} ms '
+                      f'({r["parse"]})')
     if errors:
-        logging.error('\n'.join([str(e) for e in errors]))
         sys.exit(1)
 
 
 @teps.command()
 @click.option('--teps-folder', default=LOCAL_TEP_FOLDER,
               help='the folder that contains the TEP files')
-@click.option('--title', '-t', required=True,
-              help='the title for the TEP in a few words')
+@click.option('--title', '-t', required=True, multiple=True,
+              help='the title for the TEP in a few words, repeat it to '
+                   'create several TEPs')
 @click.option('--author', '-a', multiple=True,
               help='the Github username of the TEP author')
 @click.option('--collaborator', '-c', multiple=True,
               help='the Github username of the TEP collaborator')
 @click.option('--update-table/--no-update-table', default=True,
               help='whether to refresh the table of TEPs')
-def new(teps_folder, title, author, collaborator, update_table):
-    """ Create a new TEP with a new valid number from the template """
+@click.option('--offline', is_flag=True, default=False,
+              help='use cached open PRs instead of querying GitHub')
+@click.pass_obj
+def new(options, teps_folder, title, author, collaborator, update_table, offline):
+    """ Create new TEPs with new valid numbers from the template """
     if not os.path.isdir(teps_folder):
         logging.error(f'Invalid TEP folder {teps_folder}')
         sys.exit(1)
-    tep_number = next_tep_number(teps_folder)
-    title_slug = "".join(x for x in title if x.isalnum() or x == ' ')
-    title_slug = title_slug.replace(' ', '-').lower()
-    tep_filename = f'{tep_number:04d}-{title_slug}.md'
-    tep = dict(title=title, authors=author, collaborators=collaborator,
-               status='proposed',
-               number=tep_number)
-    tep['creation-date'] = str(date.today())
-    tep['last-updated'] =str(date.today())
-    with open(os.path.join(teps_folder, tep_filename), 'w+') as new_tep:
-        write_tep_header(tep, new_tep)
-        with open(TEP_TEMPLATE, 'r') as template:
-            new_tep.write(template.read())
+    tep_numbers = next_tep_numbers(
+        teps_folder, len(title), pull_requests=github_pull_requests(
+            teps_folder, offline, options['cache']),
+        **options)
+    with open(TEP_TEMPLATE, 'r') as template:
+        template = template.read()
+    new_teps = {}
+    for tep_title, tep_number in zip(title, tep_numbers):
+        title_slug = "".join(x for x in tep_title if x.isalnum() or x == ' ')
+        title_slug = title_slug.replace(' ', '-').lower()
+        tep_filename = f'{tep_number:04d}-{title_slug}.md'
+        tep = dict(title=tep_title, authors=author, collaborators=collaborator,
+                   status='proposed',
+                   number=tep_number)
+        tep['creation-date'] = str(date.today())
+        tep['last-updated'] =str(date.today())
+        new_teps[tep_filename] = tep_content(tep, template)
+    write_teps(teps_folder, new_teps)
 
     # By default, regenerate the TEP folder
     if update_table:
-        generate_tep_table(teps_folder)
+        generate_tep_table(teps_folder, **options)
 
     # Return git help to execute
-    print(f'\n\nTo stage the new TEP please run:\n\n'
+    git_add = '\n'.join(f'git add {os.path.join(teps_folder, f)}'
+                        for f in new_teps)
+    print(f'\n\nTo stage the new TEPs please run:\n\n'
           f'git status    # optional\n'
-          f'git add {os.path.join(teps_folder, tep_filename)}\n')
+          f'{git_add}\n')
 
 
 @teps.command()
 @click.option('--teps-folder', default=LOCAL_TEP_FOLDER,
               help='the folder that contains the TEP files')
-@click.option('--filename', '-f', default=None,
-              help='the filename of the TEP to refresh')
+@click.option('--filename', '-f', multiple=True, required=True,
+              help='the filename of the TEP to refresh, or a glob pattern; '
+                   'repeat it to refresh several TEPs')
 @click.option('--update-table/--no-update-table', default=True,
               help='whether to refresh the table of TEPs')
-def renumber(teps_folder, filename, update_table):
-    """ Obtain a fresh TEP number and refresh the TEP and TEPs table """
+@click.option('--offline', is_flag=True, default=False,
+              help='use cached open PRs instead of querying GitHub')
+@click.pass_obj
+def renumber(options, teps_folder, filename, update_table, offline):
+    """ Obtain fresh TEP numbers and refresh the TEPs and TEPs table """
     if not os.path.isdir(teps_folder):
         logging.error(f'Invalid TEP folder {teps_folder}')
         sys.exit(1)
+    filenames = tep_filenames(teps_folder, filename)
+    if not filenames:
+        logging.error('No TEP to renumber')
+        sys.exit(1)
+    missing = [f for f in filenames
+               if not os.path.isfile(os.path.join(teps_folder, f))]
+    if missing:
+        logging.error(f'TEPs not found in {teps_folder}: {", ".join(missing)}')
+        sys.exit(1)
 
-    # Load the TEP header first
-    source_filename = os.path.join(teps_folder, filename)
-    try:
-        tep, body = tep_from_file(source_filename, with_body=True)
-    except ValidationErrors as ve:
+    # Load the TEP headers first
+    loaded = []
+    for source in filenames:
+        source_filename = os.path.join(teps_folder, source)
+        with open(source_filename, 'r') as tep_io:
+            # Use the rt loader so that header comments are preserved
+            tep, body, issues = read_tep(
+                tep_io, with_body=True, ignore_errors=True, loader='rt')
         # If validation errors are related to the TEP number
         # we may be able to fix them
-        non_number_errors = [e for e in ve is not isinstance(ve, InvalidTepNumber)]
-        logging.warning(f'Validation issues found. Please fix them '
-                        f'before updating the PR: {non_number_errors}')
-        if len(ve) == len(non_number_errors):
-            logging.warning('No number issues found, refreshing anyways')
-
-    # Obtain a new TEP number
-    tep_number = next_tep_number(teps_folder)
-    tep['number'] = tep_number
-
-    # Build the target TEP filename
-    filename_match = RE_TEP_4ALPHANUM_FILENAME.match(filename)
-    base_filename = filename
-    if filename_match:
-        base_filename = filename_match.groups()[0]
-    target_filename = f'{tep_number:04d}-{base_filename}'
-    target_filename = os.path.join(teps_folder, target_filename)
-
-    with open(target_filename, 'w+') as target:
-        # First re-write the header that was parsed
-        write_tep_header(tep, target)
-        # Write the parsed body
-        target.write(body)
-
-    logging.info(f'New TEP {target_filename} created')
+        non_number_errors = [
+            e for e in issues if not isinstance(e, InvalidTepNumber)]
+        if non_number_errors:
+            logging.warning(f'Validation issues found in {source}. Please '
+                            f'fix them before updating the PR: '
+                            f'{non_number_errors}')
+        if issues and len(issues) == len(non_number_errors):
+            logging.warning(f'No number issues found in {source}, '
+                            f'refreshing anyways')
+        loaded.append((source, tep, body))
+
+    # Obtain a block of new TEP numbers
+    tep_numbers = next_tep_numbers(
+        teps_folder, len(loaded), pull_requests=github_pull_requests(
+            teps_folder, offline, options['cache']),
+        **options)
+
+    renumbered = {}
+    modes = {}
+    for (source, tep, body), tep_number in zip(loaded, tep_numbers):
+        tep['number'] = tep_number
+        # Build the target TEP filename
+        filename_match = RE_TEP_4ALPHANUM_FILENAME.match(source)
+        base_filename = source
+        if filename_match:
+            base_filename = filename_match.groups()[0]
+        target_filename = f'{tep_number:04d}-{base_filename}'
+        # Re-write the header that was parsed and the parsed body
+        renumbered[target_filename] = tep_content(tep, body)
+        # Keep the mode of the source TEP
+        modes[target_filename] = os.stat(
+            os.path.join(teps_folder, source)).st_mode & 0o7777
+    write_teps(teps_folder, renumbered, modes)
+
+    for (source, _, _), target in zip(loaded, renumbered):
+        logging.info(f'New TEP {target} created from {source}')
 
     # By default, regenerate the TEP folder
     if update_table:
-        generate_tep_table(teps_folder)
+        generate_tep_table(teps_folder, **options)
 
     # Return git commands to execute
+    git_add = '\n'.join(f'git add {os.path.join(teps_folder, f)}'
+                        for f in renumbered)
+    git_rm = '\n'.join(f'git rm {os.path.join(teps_folder, f)}'
+                       for f, _, _ in loaded)
     print(f'\n\nTo complete the PR please run:\n\n'
           f'git status    # optional\n'
           f'git diff      # optional\n'
-          f'git add {target_filename}\n'
-          f'git rm {source_filename}\n'
+          f'{git_add}\n'
+          f'{git_rm}\n'
           f'git add -u\n'
           f'git commit --amend\n')
 
 
+@teps.command()
+@click.option('--teps-folder', default=LOCAL_TEP_FOLDER,
+              help='the folder that contains the TEP files')
+@click.option('--interval', default=1.0, type=click.FloatRange(min=0.1),
+              help='seconds between checks for changed TEPs')
+@click.option('--debounce', default=0.5, type=click.FloatRange(min=0),
+              help='seconds TEPs must stay unchanged before they are checked')
+@click.pass_obj
+def watch(options, teps_folder, interval, debounce):
+    """ Validate changed TEPs and refresh the table of TEPs as they change """
+    if not os.path.isdir(teps_folder):
+        logging.error(f'Invalid TEP folder {teps_folder}')
+        sys.exit(1)
+
+    # Metadata of all TEPs is kept in memory, only changed TEPs are parsed
+    parsed = {}
+    for tep_file, tep, issues in load_teps(teps_folder, **options):
+        parsed[tep_file] = (tep, issues)
+        for e in tep_errors(tep_file, tep, issues):
+            logging.error(str(e))
+    write_tep_table(teps_folder, [(f, *parsed[f]) for f in sorted(parsed)],
+                    cache=options['cache'])
+    print(f'Watching {len(parsed)} TEPs in {teps_folder}')
+
+    try:
+        for changed, removed in watch_teps(teps_folder, interval, debounce):
+            for tep_file in removed:
+                # TEPs that appeared after load_teps may not be parsed yet
+                parsed.pop(tep_file, None)
+                print(f'{tep_file} removed')
+            for tep_file in changed:
+                try:
+                    tep, issues = parse_tep_file(
+                        os.path.join(teps_folder, tep_file),
+                        loader=options['loader'])
+                except OSError as e:
+                    # Removed since the snapshot, the next one reports it
+                    logging.warning(f'Could not read {tep_file}: {e}')
+                    parsed.pop(tep_file, None)
+                    continue
+                issues = decode_issues(issues)
+                parsed[tep_file] = (tep, issues)
+                errors = tep_errors(tep_file, tep, issues)
+                number = tep.get('number')
+                errors.extend(
+                    InvalidTepNumber(f'{tep_file} uses {number} which is '
+                                     f'also used by {other_file}')
+                    for other_file, (other, _) in sorted(parsed.items())
+                    if other_file != tep_file and other.get('number') == number)
+                for e in errors:
+                    logging.error(str(e))
+                print(f'{tep_file} {"is valid" if not errors else "has errors"}')
+            if write_tep_table(
+                    teps_folder, [(f, *parsed[f]) for f in sorted(parsed)],
+                    cache=options['cache']):
+                print(f'{README} updated')
+    except KeyboardInterrupt:
+        pass
+
+
+@teps.command()
+@click.option('--teps-folder', default=LOCAL_TEP_FOLDER,
+              help='the folder that contains the TEP files')
+@click.pass_obj
+def index(options, teps_folder):
+    """ Build or update the full text index of the TEPs """
+    if not os.path.isdir(teps_folder):
+        logging.error(f'Invalid TEP folder {teps_folder}')
+        sys.exit(1)
+    tep_index = TepIndex(os.path.join(teps_folder, INDEX_FILENAME))
+    indexed, removed = tep_index.update(teps_folder, loader=options['loader'])
+    if indexed or removed or not os.path.exists(tep_index.path):
+        tep_index.save()
+    print(f'{len(tep_index.teps)} TEPs and {len(tep_index.postings)} terms '
+          f'indexed ({indexed} updated, {removed} removed)')
+
+
+@teps.command()
+@click.option('--teps-folder', default=LOCAL_TEP_FOLDER,
+              help='the folder that contains the TEP files')
+@click.option('--status', '-s', multiple=True,
+              help='only show TEPs with this status')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='only show TEPs last updated on or after this date')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='only show TEPs last updated on or before this date')
+@click.option('--limit', '-n', default=20, type=click.IntRange(min=1),
+              help='the maximum number of TEPs to show')
+@click.argument('query', nargs=-1, required=True)
+def search(teps_folder, status, since, until, limit, query):
+    """ Search the TEPs in the full text index """
+    index_filename = os.path.join(teps_folder, INDEX_FILENAME)
+    if not os.path.exists(index_filename):
+        logging.error(f'No TEP index in {teps_folder}, run "teps.py index"')
+        sys.exit(1)
+    results = TepIndex(index_filename).search(
+        ' '.join(query), statuses=status,
+        since=since.date() if since else None,
+        until=until.date() if until else None)
+    for score, tep_file, tep in results[:limit]:
+        print(f'{tep["number"]}  {(tep["status"] or "").strip():<13} '
+              f'{tep["last-updated"]}  {tep["title"]}')
+    if len(results) > limit:
+        print(f'... {len(results) - limit} more TEPs')
+
+
 if __name__ == '__main__':
     teps()
@@ -0,0 +1,283 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import chevron
+import pytest
+
+import teps
+
+
+TEMPLATE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', teps.README_TEMPLATE)
+
+
+def loaded_teps(count):
+    """ returns a list of (filename, TEP dict, issues) as from load_teps """
+    loaded = []
+    for number in range(1, count + 1):
+        link = f'{number:04d}-tep-{number}.md'
+        tep = {'link': link, 'title': f'TEP {number}',
+               'status': 'proposed', 'creation-date': '2021-01-01',
+               'last-updated': f'2021-02-{number % 28 + 1:02d}',
+               'authors': ['@alice'], 'collaborators': [],
+               'number': f'TEP-{number:04d}'}
+        loaded.append((link, tep, []))
+    return loaded
+
+
+def full_render(loaded):
+    with open(TEMPLATE, 'r') as template:
+        template = template.read()
+    rows = [dict(tep, lastupdated=tep['last-updated'])
+            for _, tep, _ in loaded]
+    return chevron.render(template, dict(
+        teps=sorted(rows, key=lambda k: k['number'])))
+
+
+@pytest.fixture
+def teps_folder(tmp_path):
+    shutil.copy(TEMPLATE, tmp_path)
+    return str(tmp_path)
+
+
+def read_readme(teps_folder):
+    with open(os.path.join(teps_folder, teps.README), 'r') as readme:
+        return readme.read()
+
+
+def write_readme(teps_folder, content):
+    with open(os.path.join(teps_folder, teps.README), 'w') as readme:
+        readme.write(content)
+
+
+def warm_table_cache(teps_folder, loaded):
+    """ write the README once, so that the keys of its rows are cached """
+    teps.write_tep_table(teps_folder, loaded)
+    assert os.path.exists(os.path.join(teps_folder, teps.TABLE_CACHE_FILENAME))
+
+
+def test_write_tep_table_empty(teps_folder):
+    loaded = loaded_teps(5)
+    assert teps.write_tep_table(teps_folder, loaded)
+    assert read_readme(teps_folder) == full_render(loaded)
+
+
+def test_write_tep_table_current(teps_folder):
+    loaded = loaded_teps(5)
+    warm_table_cache(teps_folder, loaded)
+    assert not teps.write_tep_table(teps_folder, loaded_teps(5))
+    assert read_readme(teps_folder) == full_render(loaded)
+
+
+@pytest.mark.parametrize('edit', [
+    lambda readme: readme.replace('TEP 3', 'TEP three'),
+    lambda readme: readme.replace('0002-tep-2.md', '0002-other.md'),
+    lambda readme: readme.replace('\n|[TEP-0002]', '\n\n|[TEP-0002]'),
+    lambda readme: readme + '\nsome text\n',
+    lambda readme: 'some text\n' + readme,
+])
+@pytest.mark.parametrize('cache', [True, False])
+def test_write_tep_table_edited(teps_folder, edit, cache):
+    loaded = loaded_teps(5)
+    warm_table_cache(teps_folder, loaded)
+    write_readme(teps_folder, edit(full_render(loaded)))
+    assert teps.write_tep_table(teps_folder, loaded_teps(5), cache=cache)
+    assert read_readme(teps_folder) == full_render(loaded)
+
+
+def test_write_tep_table_changed_teps(teps_folder):
+    warm_table_cache(teps_folder, loaded_teps(5))
+    loaded = loaded_teps(6)
+    loaded[1][1]['status'] = 'implemented'
+    del loaded[3]
+    assert teps.write_tep_table(teps_folder, loaded)
+    assert read_readme(teps_folder) == full_render(loaded)
+
+
+def test_write_tep_table_truncated(teps_folder):
+    loaded = loaded_teps(5)
+    warm_table_cache(teps_folder, loaded)
+    full = full_render(loaded)
+    write_readme(teps_folder, full[:len(full) // 2])
+    assert teps.write_tep_table(teps_folder, loaded_teps(5))
+    assert read_readme(teps_folder) == full
+
+
+def table_teps(loaded):
+    return dict(teps=sorted(
+        [dict(tep, lastupdated=tep['last-updated']) for _, tep, _ in loaded],
+        key=lambda k: k['number']))
+
+
+def test_update_tep_table_renders_changed_rows():
+    with open(TEMPLATE, 'r') as template:
+        template = template.read()
+    rows_cache = {}
+    loaded = loaded_teps(5)
+    readme, rendered = teps.update_tep_table(
+        template, table_teps(loaded), '', rows_cache)
+    assert (readme, rendered) == (full_render(loaded), 5)
+    assert sorted(rows_cache) == [link for link, _, _ in loaded]
+
+    # Nothing changed, all rows are reused
+    assert teps.update_tep_table(
+        template, table_teps(loaded), readme, rows_cache) == (readme, 0)
+
+    # Only the changed and new rows are rendered, removed rows are dropped
+    loaded = loaded_teps(7)
+    loaded[1][1]['title'] = 'A new title'
+    del loaded[3]
+    updated, rendered = teps.update_tep_table(
+        template, table_teps(loaded), readme, rows_cache)
+    assert (updated, rendered) == (full_render(loaded), 3)
+    assert sorted(rows_cache) == [link for link, _, _ in loaded]
+
+    # Rows rendered from another row template are rendered again
+    other_template = template.replace('{{status}}', '*{{status}}*')
+    updated, rendered = teps.update_tep_table(
+        other_template, table_teps(loaded), updated, rows_cache)
+    assert rendered == 6
+    assert updated == chevron.render(other_template, table_teps(loaded))
+
+
+@pytest.mark.parametrize('patterns,path,ignored', [
+    (['*.so', '*.py[cod]'], 'teps/0123-x.sodium.md', False),
+    (['*.so', '*.py[cod]'], 'teps/foo.pyc-notes.md', False),
+    (['*.so', '*.py[cod]'], 'teps/lib.so', True),
+    (['*.so', '*.py[cod]'], 'teps/tools/teps.pyc', True),
+    (['build', 'build.md'], 'teps/build-notes.md', False),
+    (['build', 'build.md'], 'teps/build/0001-x.md', True),
+    (['*.md', '!0001-*.md'], 'teps/0001-x.md', False),
+    (['*.md', '!0001-*.md'], 'teps/0001-x.md.bak', False),
+    (['*.md', '!0001-*.md'], 'teps/0002-x.md', True),
+    (['/teps/*.md', '!*.md', 'teps/0001-*'], 'teps/0001-x.md', True),
+])
+def test_compile_gitignore(patterns, path, ignored):
+    assert teps.compile_gitignore(patterns)(path) == ignored
+
+
+def test_compile_gitignore_repo(tmp_path):
+    git = shutil.which('git')
+    if not git:
+        pytest.skip('git is not installed')
+    patterns = ['*.so', '*.py[cod]', 'build/', '*.md', '!0*.md', '0002-*']
+    (tmp_path / '.gitignore').write_text('\n'.join(patterns) + '\n')
+    subprocess.run([git, 'init', '-q', str(tmp_path)], check=True)
+    paths = ['teps/0123-x.sodium.md', 'teps/foo.pyc-notes.md', 'teps/x.so',
+             'teps/0001-x.md', 'teps/0002-x.md', 'teps/notes.md',
+             'teps/build/0003-x.md', 'teps/build.md']
+    result = subprocess.run(
+        [git, '-C', str(tmp_path), 'check-ignore', '--no-index', *paths],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    expected = set(result.stdout.split())
+    ignored = teps.compile_gitignore(patterns)
+    assert {p for p in paths if ignored(p)} == expected
+
+
+def test_write_teps_modes(tmp_path):
+    umask = os.umask(0o022)
+    try:
+        teps.write_teps(str(tmp_path), {'0001-new.md': 'new\n',
+                                        '0002-renumbered.md': 'old\n'},
+                        modes={'0002-renumbered.md': 0o640})
+    finally:
+        os.umask(umask)
+    assert os.stat(tmp_path / '0001-new.md').st_mode & 0o7777 == 0o644
+    assert os.stat(tmp_path / '0002-renumbered.md').st_mode & 0o7777 == 0o640
+    assert sorted(os.listdir(tmp_path)) == ['0001-new.md', '0002-renumbered.md']
+
+
+# Import time budget of the modules imported by teps.py, in milliseconds
+STARTUP_BUDGET = 50
+# Modules only needed to render the table or query GitHub
+LAZY_MODULES = ['chevron', 'ruamel.yaml', 'urllib.request', 'json']
+
+
+def import_times(command):
+    """ returns the cumulative import time in us of each module imported
+    by teps.py when running command, without the interpreter startup """
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime',
+         os.path.join(os.path.dirname(os.path.abspath(__file__)), 'teps.py'),
+         *command], check=True, capture_output=True, text=True).stderr
+    times = {}
+    started = False
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        if started:
+            times[name.strip()] = (int(cumulative), not name.startswith('  '))
+        # Modules before site are imported by the interpreter itself
+        started = started or name.strip() == 'site'
+    return times
+
+
+def test_startup_imports():
+    runs = [import_times(['validate', '--help']) for _ in range(3)]
+    totals = [sum(t for t, top in times.values() if top) for times in runs]
+    best = runs[totals.index(min(totals))]
+    assert min(totals) / 1000 <= STARTUP_BUDGET
+    assert [m for m in LAZY_MODULES if m in best] == []
+
+
+def test_validate_json_issues(tmp_path):
+    import json
+    from click.testing import CliRunner
+    (tmp_path / '0001-broken.md').write_text(
+        '---\ntitle: [unclosed\n---\n\n# TEP-0002: Broken\n')
+    result = CliRunner().invoke(teps.teps, [
+        '--no-cache', 'validate', '--teps-folder', str(tmp_path),
+        '--format', 'json'])
+    assert result.exit_code == 1
+    report = json.loads(result.stdout)
+    issues = report['teps'][0]['issues']
+    # One entry per issue, missing fields included
+    assert len(issues) == 2 + len(teps.REQUIRED_FIELDS)
+    assert any('does not match TEP number' in issue for issue in issues)
+    assert [i for i in issues if i.endswith('missing in 0001-broken.md')] == [
+        f'{field} missing in 0001-broken.md' for field in teps.REQUIRED_FIELDS]
+
+
+@pytest.mark.parametrize('content', [
+    # No newline at all
+    '---\ntitle: ' + 'x' * (2 * teps.HEADER_MAX_BYTES),
+    # Fewer characters than the limit, but more bytes
+    '---\n' + '# €€€\n' * (teps.HEADER_MAX_BYTES // 8) +
+    '---\n\n# TEP-0001: Title\n',
+])
+def test_read_tep_header_too_large(content):
+    import io
+    tep_io = io.StringIO(content)
+    tep_io.name = '0001-large.md'
+    tep, _, issues = teps.read_tep(tep_io, with_body=False, ignore_errors=True)
+    assert [str(i) for i in issues] == [
+        f'Header too large in 0001-large.md, no TEP number title '
+        f'(# TEP-NNNN) in its first {teps.HEADER_MAX_BYTES} bytes']
+    assert tep['number'] == 'TEP-0001'
+    assert tep_io.tell() <= teps.HEADER_MAX_BYTES + 1
+
+
+def test_watch_missing_teps(teps_folder, monkeypatch):
+    from click.testing import CliRunner
+    with open(os.path.join(teps_folder, '0001-tep.md'), 'w') as tep_io:
+        tep_io.write('---\ntitle: A TEP\nauthors:\n- \'@alice\'\n'
+                     'creation-date: 2021-01-01\nstatus: proposed\n---\n\n'
+                     '# TEP-0001: A TEP\n')
+
+    def watch_teps(teps_folder, interval, debounce):
+        # A TEP created and removed between two snapshots, then a TEP
+        # removed before it could be parsed
+        yield [], ['0002-created.md']
+        yield ['0003-removed.md'], []
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(teps, 'watch_teps', watch_teps)
+    result = CliRunner().invoke(teps.teps, [
+        '--no-cache', 'watch', '--teps-folder', teps_folder])
+    assert result.exit_code == 0, result.output
+    assert '0002-created.md removed' in result.output
+    assert '0001-tep.md' in read_readme(teps_folder)